@@ -0,0 +1,18 @@
+"""
+ASGI config for aicon project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serving the app with an ASGI server (e.g. uvicorn) lets the submission status event
+streams wait without holding a worker, see app.events.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'aicon.settings')
+
+application = get_asgi_application()
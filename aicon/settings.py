@@ -80,6 +80,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'app.context_processors.announcements',
+                'app.context_processors.submission_row_cache',
             ],
         },
     },
@@ -115,6 +116,34 @@ DATABASES = {
 }
 
 
+# Cache
+# Shared state (queue positions, change versions, ...) needs a cache shared by all processes in production
+
+CACHE_LOCMEM = {
+    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+}
+
+CACHE_REDIS = {
+    "BACKEND": "django.core.cache.backends.redis.RedisCache",
+    "LOCATION": os.getenv("CACHE_REDIS_LOCATION", "redis://127.0.0.1:6379"),
+}
+
+CACHE_MEMCACHED = {
+    "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+    "LOCATION": os.getenv("CACHE_MEMCACHED_LOCATION", "127.0.0.1:11211"),
+}
+
+CACHE_BACKEND = {
+    'locmem': CACHE_LOCMEM,
+    'redis': CACHE_REDIS,
+    'memcached': CACHE_MEMCACHED,
+}
+
+CACHES = {
+    'default': CACHE_BACKEND[os.getenv("CACHE_BACKEND", 'locmem')]
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -210,10 +239,82 @@ ROLES = {
     'submission.rerun': ROLES_SUBMISSION_RERUN,
 }
 
+# Similarity engine (app.similarity)
+
+SIMILARITY_INDEX_ON_FINISH = os.getenv("SIMILARITY_INDEX_ON_FINISH", "true").lower() == "true"
+SIMILARITY_MIN_SCORE = float(os.getenv("SIMILARITY_MIN_SCORE", 0.5))
+
+# Queue positions (app.queues), rebuilt from the database at least this often
+
+QUEUE_POSITIONS_TIMEOUT = int(os.getenv("QUEUE_POSITIONS_TIMEOUT", 30)) # Second
+
+# Job leasing (app.jobs)
+
+JOB_LEASE_DURATION = int(os.getenv("JOB_LEASE_DURATION", 600)) # Second, extended by runner heartbeats
+JOB_CLAIM_MAX_LIMIT = int(os.getenv("JOB_CLAIM_MAX_LIMIT", 50))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_REAP_INTERVAL = int(os.getenv("JOB_REAP_INTERVAL", 60)) # Second
+
+# Dispatch scheduling (app.scheduler)
+
+SCHEDULER_DEFAULT_QUEUE = os.getenv("SCHEDULER_DEFAULT_QUEUE", "celery")
+# Off for current runners, which only consume the default queue (see README, Evaluation Queues)
+SCHEDULER_ROUTE_QUEUES = os.getenv("SCHEDULER_ROUTE_QUEUES", "false").lower() == "true"
+SCHEDULER_USER_WEIGHT = float(os.getenv("SCHEDULER_USER_WEIGHT", 1.0))
+SCHEDULER_TASK_WEIGHT = float(os.getenv("SCHEDULER_TASK_WEIGHT", 0.1))
+SCHEDULER_MAX_PRIORITY = int(os.getenv("SCHEDULER_MAX_PRIORITY", 9))
+
+# Outbox (app.outbox), messages to the broker are sent by the publish_outbox command or Celery beat
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_PUBLISH_INTERVAL = float(os.getenv("OUTBOX_PUBLISH_INTERVAL", 1)) # Second
+OUTBOX_RETRY_DELAY = int(os.getenv("OUTBOX_RETRY_DELAY", 5)) # Second, doubled on each failed attempt
+OUTBOX_MAX_RETRY_DELAY = int(os.getenv("OUTBOX_MAX_RETRY_DELAY", 300)) # Second
+
+# Regrades (app.regrades), reruns of more than REGRADE_CHUNK_SIZE submissions are dispatched in chunks
+
+REGRADE_CHUNK_SIZE = int(os.getenv("REGRADE_CHUNK_SIZE", 100))
+REGRADE_MAX_IN_FLIGHT = int(os.getenv("REGRADE_MAX_IN_FLIGHT", 200))
+REGRADE_ADVANCE_INTERVAL = int(os.getenv("REGRADE_ADVANCE_INTERVAL", 10)) # Second
+
+# Task payloads sent to runners, cached per task state. Compact payloads only carry the task id,
+# version and API URL
+
+TASK_DATA_CACHE_TIMEOUT = int(os.getenv("TASK_DATA_CACHE_TIMEOUT", 3600)) # Second
+TASK_DATA_COMPACT = os.getenv("TASK_DATA_COMPACT", "false").lower() == "true"
+
+# Submission status events (app.events), streamed to the pages as server-sent events when
+# the versions are shared by all processes and the app is served over ASGI (aicon.asgi)
+
+EVENTS_PUSH = os.getenv("EVENTS_PUSH", str(CACHES['default'] is not CACHE_LOCMEM)).lower() == "true"
+EVENTS_VERSION_TIMEOUT = int(os.getenv("EVENTS_VERSION_TIMEOUT", 86400)) # Second
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", 1)) # Second, between two cache reads
+EVENTS_KEEP_ALIVE = int(os.getenv("EVENTS_KEEP_ALIVE", 15)) # Second
+EVENTS_STREAM_TIMEOUT = int(os.getenv("EVENTS_STREAM_TIMEOUT", 60)) # Second, before the client reconnects
+EVENTS_RETRY = int(os.getenv("EVENTS_RETRY", 1000)) # Millisecond
+# Answer unchanged partial polls with 304 from the versions alone. The versions must be shared
+# by all processes, so it is off by default with the per-process locmem cache.
+EVENTS_CONDITIONAL_PARTIALS = os.getenv("EVENTS_CONDITIONAL_PARTIALS", str(CACHES['default'] is not CACHE_LOCMEM)).lower() == "true"
+
+# Rendered rows of finished submissions (partials/submission.html) and their evaluation details
+
+SUBMISSION_ROW_CACHE_TIMEOUT = int(os.getenv("SUBMISSION_ROW_CACHE_TIMEOUT", 86400)) # Second, 0 to disable
+SUBMISSION_DETAILS_MAX_AGE = int(os.getenv("SUBMISSION_DETAILS_MAX_AGE", 86400)) # Second, browser cache of final evaluation details
+
 # Upload
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'uploads')
 
+# Hash uploads while they are received (see app.uploadhandlers)
+FILE_UPLOAD_HANDLERS = [
+    'app.uploadhandlers.DigestMemoryFileUploadHandler',
+    'app.uploadhandlers.DigestTemporaryFileUploadHandler',
+]
+
+# Download: let the front-end server send files, e.g. nginx "internal" location mapped to MEDIA_ROOT
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = os.getenv("DOWNLOAD_ACCEL_REDIRECT_PREFIX") # e.g. /protected/
+DOWNLOAD_SENDFILE = os.getenv("DOWNLOAD_SENDFILE", "false").lower() == "true" # Apache mod_xsendfile
+
 # Django Rest Framework
 
 REST_FRAMEWORK = {
@@ -233,11 +334,36 @@ CELERY_BROKER_USER = os.getenv("CELERY_BROKER_USER")
 CELERY_BROKER_PASSWORD = os.getenv("CELERY_BROKER_PASSWORD")
 CELERY_BROKER_HOST = os.getenv("CELERY_BROKER_HOST")
 CELERY_BROKER_PORT = os.getenv("CELERY_BROKER_PORT")
+# The app's own tasks (app.tasks) go to their own queue, the default queue carries the
+# evaluations consumed by the runners
+TASKS_QUEUE = os.getenv("TASKS_QUEUE", "aicon")
+CELERY_TASK_ROUTES = {
+    'app.tasks.*': {'queue': TASKS_QUEUE},
+}
+CELERY_BEAT_SCHEDULE = {
+    'reap-expired-jobs': {
+        'task': 'app.tasks.reap_expired_jobs',
+        'schedule': JOB_REAP_INTERVAL,
+    },
+    'publish-outbox': {
+        'task': 'app.tasks.publish_outbox',
+        'schedule': OUTBOX_PUBLISH_INTERVAL,
+    },
+    'advance-regrades': {
+        'task': 'app.tasks.advance_regrades',
+        'schedule': REGRADE_ADVANCE_INTERVAL,
+    },
+}
+
+# Absolute URLs outside of a request (e.g. job payloads sent by periodic tasks)
+BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:8000")
 
 # Template files
 SUBMISSION_BASE_ZIPFILE = os.path.join(BASE_DIR, "uploads", "base", "submission.zip")
 SUBMISSION_BASE_MAIN_DIR = "aicon_submission"
 SUBMISSION_BASE_MAIN_FILE = os.path.join(SUBMISSION_BASE_MAIN_DIR, "__init__.py")
+SUBMISSION_MAX_ENTRIES = int(os.getenv("SUBMISSION_MAX_ENTRIES", 1000))
+SUBMISSION_MAX_UNCOMPRESSED_SIZE = int(os.getenv("SUBMISSION_MAX_UNCOMPRESSED_SIZE", 512 * 1024 * 1024)) # Bytes
 
 TASK_BASE_ZIPFILE = os.path.join(BASE_DIR, "uploads", "base", "task.zip")
 TASK_BASE_MAIN_DIR = "aicon_task"
@@ -40,9 +40,14 @@ urlpatterns = [
     path('courses/<int:course_pk>/tasks/<int:task_pk>/submissions/new/package/', views.submission_new_package, name='submission_new_package'),
     path('courses/<int:course_pk>/tasks/<int:task_pk>/submissions/new/code/', views.submission_new_code, name='submission_new_code'),
     path('courses/<int:course_pk>/tasks/<int:task_pk>/submissions/<int:submission_pk>/new/code/', views.submission_clone_code, name='submission_clone_code'),
+    path('courses/<int:course_pk>/tasks/<int:task_pk>/submissions/export/', views.submissions_export, name='submissions_export'),
 
     path('partial/courses/<int:course_pk>/tasks/<int:task_pk>/submissions/', views.partial_submissions, name='partial_submissions'),
     path('partial/submissions/<int:pk>/', views.partial_submission, name='partial_submission'),
+    path('partial/submissions/<int:pk>/details/', views.partial_submission_details, name='partial_submission_details'),
+
+    path('events/courses/<int:course_pk>/tasks/<int:task_pk>/submissions/', views.submissions_events, name='submissions_events'),
+    path('events/submissions/<int:pk>/', views.submission_events, name='submission_events'),
 
     path('tasks/<int:pk>/download/', views.task_download, name='task_download'),
     path('tasks/<int:pk>/template/', views.template_download, name='template_download'),
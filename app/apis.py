@@ -1,18 +1,23 @@
-from rest_framework.status import HTTP_404_NOT_FOUND
+from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAdminUser
 from rest_framework import viewsets
 from rest_framework.routers import DefaultRouter
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
-from .models import Submission, Task, Similarity, User
-from .serializers import SubmissionSerializer, TaskSerializer, SimilaritySerializer, SimilaritySubmissionSerializer
-from .funcs import can
+from .models import Submission, Task, TaskVersion, Similarity, User
+from .serializers import SubmissionSerializer, JobSerializer, JobResultSerializer, TaskSerializer, SimilaritySerializer, SimilaritySubmissionSerializer
+from .funcs import can, export_submissions, get_tasks_data
 from .utils import create_download_response
+from . import jobs
 
 from itertools import groupby
 import json
 
+IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
 class JobViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Submission.objects.all()
     serializer_class = SubmissionSerializer
@@ -24,16 +29,42 @@ class JobViewSet(viewsets.ReadOnlyModelViewSet):
             serializer = self.get_serializer(submissions, many=True)
             return Response(serializer.data)
 
+    @action(detail=False, methods=['post'])
+    def claim(self, request):
+        json_data = json.loads(request.body or b'{}')
+        try:
+            limit = int(json_data.get('limit', 1))
+        except (TypeError, ValueError):
+            return Response({'limit': 'Must be an integer.'}, status=HTTP_400_BAD_REQUEST)
+
+        partitions, gpus = json_data.get('partitions'), json_data.get('gpus')
+        if partitions is not None and (not isinstance(partitions, list) or
+                                       not all(name is None or isinstance(name, str) for name in partitions)):
+            return Response({'partitions': 'Must be a list of partition names or null.'}, status=HTTP_400_BAD_REQUEST)
+        if gpus is not None and not isinstance(gpus, bool) and (not isinstance(gpus, list) or
+                                                                 not all(isinstance(gpu, str) for gpu in gpus)):
+            return Response({'gpus': 'Must be a boolean or a list of GPU requirements.'}, status=HTTP_400_BAD_REQUEST)
+
+        submissions = jobs.claim_jobs(limit, partitions=partitions, gpus=gpus)
+        serializer = JobSerializer(submissions, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['post'])
+    def heartbeat(self, request):
+        json_data = json.loads(request.body or b'{}')
+        lease_ids = json_data.get('lease_ids')
+        if not isinstance(lease_ids, list):
+            return Response({'lease_ids': 'Must be a list.'}, status=HTTP_400_BAD_REQUEST)
+
+        return Response({'lease_ids': jobs.heartbeat(lease_ids)})
+
     @action(detail=True, methods=['post'])
     def run(self, request, pk):
-        try:
-            submission = Submission.objects.get(pk=pk, status=Submission.STATUS_QUEUED)
-        except Submission.DoesNotExist:
+        submission = jobs.claim_job(pk)
+        if submission is None:
             return Response(status=HTTP_404_NOT_FOUND)
 
-        submission.status = Submission.STATUS_RUNNING
-        submission.save()
-        serializer = self.get_serializer(submission)
+        serializer = JobSerializer(submission, context=self.get_serializer_context())
         return Response(serializer.data)
 
     @action(detail=True, methods=['post'])
@@ -47,45 +78,104 @@ class JobViewSet(viewsets.ReadOnlyModelViewSet):
             return Response(status=HTTP_404_NOT_FOUND)
 
         json_data = json.loads(request.body)
+        if json_data.get('lease_id') and json_data['lease_id'] != submission.lease_id: # Reaped and claimed again
+            return Response(status=HTTP_404_NOT_FOUND)
+
         status = json_data.get('status')
         if status and status in STATUS_ALLOWED:
 	        for key, value in json_data.items():
 	            if key in UPDATE_ALLOWED:
 	                setattr(submission, key, value)
+	        submission.lease_id = None
+	        submission.lease_expires_at = None
 	        submission.save()
+	        jobs.jobs_finished([submission.pk])
 
         serializer = self.get_serializer(submission)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['post'])
+    def end_batch(self, request):
+        results = request.data.get('results') if isinstance(request.data, dict) else request.data
+        if not isinstance(results, list):
+            return Response({'results': 'Must be a list.'}, status=HTTP_400_BAD_REQUEST)
+
+        # Results are validated one by one, an invalid one doesn't drop the others
+        valid, invalid = [], []
+        for result in results:
+            serializer = JobResultSerializer(data=result)
+            if serializer.is_valid():
+                valid.append(serializer.validated_data)
+            else:
+                invalid.append({'id': result.get('id') if isinstance(result, dict) else None, 'errors': serializer.errors})
+
+        ended, rejected = jobs.end_jobs(valid)
+        return Response({'ended': ended, 'rejected': rejected, 'invalid': invalid})
+
 class TaskViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Task.objects.all()
+    queryset = Task.objects.order_by('pk')
     serializer_class = TaskSerializer
     permission_classes = (IsAdminUser,)
 
+    def list(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        tasks = list(queryset if page is None else page)
+        tasks_data = get_tasks_data(tasks, request)
+        data = [tasks_data[task.pk] for task in tasks]
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+    def retrieve(self, request, pk):
+        task = self.get_object()
+        return Response(get_tasks_data([task], request)[task.pk])
+
     @action(detail=True, methods=['get'])
     def submissions_by_user(self, request, pk):
         if request.method == 'GET':
             task = Task.objects.get(pk=pk)
-            submissions = task.submissions.all()
+            submissions = task.submissions.select_related('user')
             key = lambda x: x.user
             grouped_submissions = groupby(sorted(submissions, key=lambda x: x.user.pk), key=key)
             result = {}
             for user, submissions in grouped_submissions:
-                if can(task.course, user, 'task.edit') or not user.is_active:
+                if can(task.course, user, 'task.edit', request=request) or not user.is_active:
                     continue
                 serializer = SimilaritySubmissionSerializer(submissions, many=True, context={'request': request})
                 result[user.pk] = serializer.data
             return Response(result)
 
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk):
+        task = Task.objects.get(pk=pk)
+        select = 'best' if request.query_params.get('select') == 'best' else 'latest'
+        response = StreamingHttpResponse(export_submissions(task, select), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename=%s' % f"task_{task.pk}_{select}.zip"
+        return response
+
     @action(detail=True, methods=['get'])
     def download(self, request, pk):
         task = Task.objects.get(pk=pk)
-        return create_download_response(task.file, 'application/zip')
+        return create_download_response(request, task.file, 'application/zip', etag=task.file_hash)
 
     @action(detail=True, methods=['get'])
     def template_download(self, request, pk):
         task = Task.objects.get(pk=pk)
-        return create_download_response(task.template, 'application/zip')
+        return create_download_response(request, task.template, 'application/zip')
+
+    @action(detail=True, methods=['get'], url_path=r'versions/(?P<version_pk>[0-9]+)/download', url_name='version-download')
+    def version_download(self, request, pk, version_pk):
+        version = get_object_or_404(TaskVersion, pk=version_pk, task_id=pk)
+        return create_download_response(request, version.file, 'application/zip', etag=version.file_hash,
+                                        cache_control=IMMUTABLE_CACHE_CONTROL)
+
+    @action(detail=True, methods=['get'], url_path=r'versions/(?P<version_pk>[0-9]+)/template', url_name='version-template-download')
+    def version_template_download(self, request, pk, version_pk):
+        version = get_object_or_404(TaskVersion, pk=version_pk, task_id=pk)
+        if not version.template:
+            return Response(status=HTTP_404_NOT_FOUND)
+        return create_download_response(request, version.template, 'application/zip', cache_control=IMMUTABLE_CACHE_CONTROL)
 
 
 class SimilarityViewSet(viewsets.ReadOnlyModelViewSet):
@@ -129,7 +219,8 @@ class SubmissionViewSet(viewsets.ReadOnlyModelViewSet):
     @action(detail=True, methods=['get'])
     def download(self, request, pk):
         submission = Submission.objects.get(pk=pk)
-        return create_download_response(submission.file, 'application/zip')
+        return create_download_response(request, submission.file, 'application/zip',
+                                        filename=submission.filename, etag=submission.file_hash)
 
 
 router = DefaultRouter()
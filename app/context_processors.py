@@ -1,4 +1,9 @@
+from django.conf import settings
 from .funcs import get_announcements
 
 def announcements(request):
-    return { 'announcements': get_announcements() }
\ No newline at end of file
+    return { 'announcements': get_announcements() }
+
+
+def submission_row_cache(request):
+    return { 'submission_row_cache_timeout': settings.SUBMISSION_ROW_CACHE_TIMEOUT }
@@ -0,0 +1,85 @@
+"""
+Change versions of tasks and submissions.
+
+Each job state transition (queued, running, finished) sets a new version for the submission
+and its task in the cache, kept for EVENTS_VERSION_TIMEOUT seconds. Pages follow the versions
+through a server-sent event stream and only reload when they change, or when the queue
+moves while they show waiting submissions (their queue positions change).
+
+Streams are only offered when EVENTS_PUSH is on, which requires a cache shared by all
+processes (see CACHES), and when the app is served over ASGI, where a waiting stream doesn't
+hold a worker. Otherwise pages keep polling every 2 seconds.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from .models import Submission
+from . import queues
+import asyncio
+import time
+
+
+def task_key(task_id):
+    return f'events:task:{task_id}'
+
+
+def submission_key(submission_id):
+    return f'events:submission:{submission_id}'
+
+
+def get_version(key, default=None):
+    """The version of `key`, `default` if it was never bumped or has been evicted."""
+    version = cache.get(key)
+    return default if version is None else str(version)
+
+
+async def aget_version(key) -> str:
+    return str(await cache.aget(key, 0))
+
+
+def push_enabled(request) -> bool:
+    """Whether pages of this request follow event streams rather than polling."""
+    return settings.EVENTS_PUSH and isinstance(request, ASGIRequest)
+
+
+def bump(task_ids=(), submission_ids=()):
+    """Set new versions for the given tasks and submissions, once the transaction commits."""
+    keys = [task_key(pk) for pk in set(task_ids)] + [submission_key(pk) for pk in set(submission_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.set_many(dict.fromkeys(keys, time.time_ns()), settings.EVENTS_VERSION_TIMEOUT))
+
+
+def submissions_changed(submissions=(), pks=()):
+    """Bump submissions given as instances, or as ids (their tasks are then queried)."""
+    rows = [(s.pk, s.task_id) for s in submissions]
+    if pks:
+        rows += list(Submission.objects.filter(pk__in=pks).values_list('pk', 'task_id'))
+    bump(task_ids=[task_id for _, task_id in rows], submission_ids=[pk for pk, _ in rows])
+
+
+async def stream(key, since=None, waiting=None):
+    """
+    Server-sent events: a `changed` event with the new version every time the version of
+    `key` differs from the last one sent (or `since`). `waiting` are the followed submissions
+    that wait in the queue, a `changed` event is also sent when the queue moves while there
+    are some. The stream ends after EVENTS_STREAM_TIMEOUT seconds and the client reconnects
+    with the last event id.
+    """
+    yield f"retry: {settings.EVENTS_RETRY}\n\n"
+    last = since or await aget_version(key)
+    last_queue = await cache.aget(queues.VERSION_KEY)
+    started = keep_alive = time.monotonic()
+    while time.monotonic() - started < settings.EVENTS_STREAM_TIMEOUT:
+        version = await aget_version(key)
+        queue_version = await cache.aget(queues.VERSION_KEY)
+        queue_moved = queue_version != last_queue
+        last_queue = queue_version
+        if version != last or (queue_moved and waiting is not None and await waiting.aexists()):
+            last = version
+            keep_alive = time.monotonic()
+            yield f"id: {version}\nevent: changed\ndata: {version}\n\n"
+        elif time.monotonic() - keep_alive >= settings.EVENTS_KEEP_ALIVE:
+            keep_alive = time.monotonic()
+            yield ": keep-alive\n\n"
+        await asyncio.sleep(settings.EVENTS_POLL_INTERVAL)
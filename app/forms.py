@@ -7,9 +7,10 @@ from bootstrap_datepicker_plus.widgets import DateTimePickerInput
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Row, Column, Submit, Field, Fieldset, Div, HTML
 from aicon.settings import TASK_BASE_ZIPFILE, TASK_BASE_MAIN_DIR, TASK_BASE_MAIN_FILE, TASK_BASE_SETUP_FILE, \
-                           SUBMISSION_BASE_ZIPFILE, SUBMISSION_BASE_MAIN_DIR, SUBMISSION_BASE_MAIN_FILE
+                           SUBMISSION_BASE_ZIPFILE, SUBMISSION_BASE_MAIN_DIR, SUBMISSION_BASE_MAIN_FILE, \
+                           SUBMISSION_MAX_ENTRIES, SUBMISSION_MAX_UNCOMPRESSED_SIZE
 from .models import Invitation, Task, Submission, Course
-from .utils import create_zip_file, get_code
+from .utils import create_zip_file, get_code, validate_zip_package
 import io
 import os
 import tempfile
@@ -76,6 +77,7 @@ class TaskFormConfig:
                 css_class="row"
             ),
             'leaderboard',
+            'memoize',
             css_class='accordion-panel',
         ),
     ]
@@ -85,6 +87,7 @@ class TaskFormConfig:
         "memory_limit": "Memory limit (KB)",
         "partition": "Cluster partition",
         "gpus": "Cluster GPUs (examples: 1, a100:1)",
+        "memoize": "Reuse the result of identical submissions (disable for non-deterministic evaluations)",
     }
     WIDGETS = {
         'opened_at': DateTimePickerInput(),
@@ -92,7 +95,7 @@ class TaskFormConfig:
         'closed_at': DateTimePickerInput(range_from="deadline_at"),
     }
     FIELDS = ['daily_submission_limit', 'max_upload_size', 'run_time_limit', 'memory_limit',
-              'partition', 'gpus', 'opened_at', 'deadline_at', 'closed_at', 'leaderboard']
+              'partition', 'gpus', 'opened_at', 'deadline_at', 'closed_at', 'leaderboard', 'memoize']
 
 
 class TaskForm(forms.ModelForm):
@@ -196,21 +199,23 @@ class TaskCodeForm(forms.ModelForm):
         name = self.cleaned_data.get('name', False)
         code = self.cleaned_data.get('code', False)
         setup = self.cleaned_data.get('setup', False)
-        add_files = [(os.path.join(TASK_BASE_MAIN_DIR, file.name), file.read())
+        add_files = [(os.path.join(TASK_BASE_MAIN_DIR, file.name), file)
                      for file in self.cleaned_data.get('add_files', False)]
         delete_files = self.cleaned_data.get('delete_files')
         texts = [(TASK_BASE_MAIN_FILE, code), (TASK_BASE_SETUP_FILE, setup)]
 
         template_code = self.cleaned_data.get('template_code', False)
-        template_add_files = [(os.path.join(SUBMISSION_BASE_MAIN_DIR, file.name), file.read())
+        template_add_files = [(os.path.join(SUBMISSION_BASE_MAIN_DIR, file.name), file)
                               for file in self.cleaned_data.get('template_add_files', False)]
         template_delete_files = self.cleaned_data.get('template_delete_files')
         template_texts = [(SUBMISSION_BASE_MAIN_FILE, template_code)]
 
         with tempfile.NamedTemporaryFile(suffix='.zip', delete=True) as code_tmpf, \
              tempfile.NamedTemporaryFile(suffix='.zip', delete=True) as template_tmpf:
-            create_zip_file(code_tmpf.name, self.instance.file_path or TASK_BASE_ZIPFILE, delete_files=delete_files, add_files=add_files, texts=texts)
-            create_zip_file(template_tmpf.name,self.instance.template_file_path or  SUBMISSION_BASE_ZIPFILE, delete_files=template_delete_files, add_files=template_add_files, texts=template_texts)
+            create_zip_file(code_tmpf.name, self.instance.file_path or TASK_BASE_ZIPFILE, delete_files=delete_files, add_files=add_files, texts=texts,
+                            date_time=Task.PACKAGE_DATE_TIME)
+            create_zip_file(template_tmpf.name,self.instance.template_file_path or  SUBMISSION_BASE_ZIPFILE, delete_files=template_delete_files, add_files=template_add_files, texts=template_texts,
+                            date_time=Task.PACKAGE_DATE_TIME)
             with open(code_tmpf.name, "rb") as code_f, open(template_tmpf.name, "rb") as template_f:
                 instance.file = File(code_f, name=f"{name}.zip")
                 instance.template = File(template_f, name=f"{name}.zip")
@@ -230,6 +235,10 @@ class SubmissionForm(forms.ModelForm):
             'file': forms.FileInput(attrs={'accept':'application/zip', 'class': 'clearablefileinput form-control'}),
         }
 
+    def __init__(self, *args, upload_errors=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_errors = upload_errors or {}
+
     @property
     def helper(self):
         helper = FormHelper()
@@ -239,6 +248,8 @@ class SubmissionForm(forms.ModelForm):
     def clean_file(self):
         SUPPORTED_FILETYPES = ['application/zip', 'application/zip-compressed', 'application/x-zip-compressed', 'multipart/x-zip']
         file = self.cleaned_data.get('file', False)
+        if 'file' in self.upload_errors:
+            raise forms.ValidationError(self.upload_errors['file'], code='file_requirement_error')
         if not file:
             raise forms.ValidationError("File is required.", code='file_required')
         if file:
@@ -247,6 +258,9 @@ class SubmissionForm(forms.ModelForm):
                 message = f"File size is too large ({round(file.size/1024)}KB > {self.instance.task.max_upload_size}KB)."
             if file.content_type not in SUPPORTED_FILETYPES:
                 message = f"File type: {file.content_type} is not supported."
+            if not message:
+                message = validate_zip_package(file, Submission.MAIN_FILE, max_entries=SUBMISSION_MAX_ENTRIES,
+                                               max_uncompressed_size=SUBMISSION_MAX_UNCOMPRESSED_SIZE)
             if message:
                 raise forms.ValidationError(message, code='file_requirement_error')
         return file
@@ -278,12 +292,13 @@ class SubmissionCodeForm(forms.ModelForm):
         instance = super().save(commit=False)
         unique_id = namesgenerator.get_random_name()
         code = self.cleaned_data.get('code', False)
-        add_files = [(os.path.join(Submission.MAIN_DIR, file.name), file.read())
+        add_files = [(os.path.join(Submission.MAIN_DIR, file.name), file)
                      for file in self.cleaned_data.get('add_files', False)]
         delete_files = self.cleaned_data.get('delete_files')
 
         with tempfile.NamedTemporaryFile(suffix='.zip', delete=True) as tmpf:
-            create_zip_file(tmpf.name, self.source_zip_file, delete_files=delete_files, add_files=add_files, texts=[(Submission.MAIN_FILE, code)])
+            create_zip_file(tmpf.name, self.source_zip_file, delete_files=delete_files, add_files=add_files, texts=[(Submission.MAIN_FILE, code)],
+                            date_time=Submission.PACKAGE_DATE_TIME)
             with open(tmpf.name, "rb") as f:
                 instance.file = File(f, name=f"{unique_id}.zip")
                 if commit:
@@ -1,25 +1,29 @@
 from .models import Participation, Course, Announcement, Task, Submission
 from .forms import CourseForm
 from .serializers import TaskSerializer, SubmissionSerializer
+from .utils import stream_zip_file
+from . import events, memos, outbox, permissions, queues, scheduler
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from django.http import HttpRequest
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
 from collections import namedtuple
+from urllib.parse import urlsplit
 from cachetools import cached, TTLCache
-from aicon.celery import app as celery_app
 from rest_framework.request import Request
+from rest_framework.reverse import reverse
 
 
 CourseParticipation = namedtuple('CourseParticipation', ['course', 'participation', 'added', 'joined', 'form'], defaults=(None,) * 5)
 
 
-def can(course, user, action, participation=None, submission=None):
-    if submission and submission.user == user:
-        return True
-    if not participation:
-        participation = Participation.objects.filter(user=user, course=course).first()
-    return participation and participation.role in settings.ROLES[action]
+def can(course, user, action, participation=None, submission=None, request=None):
+    """Check an action, with the roles loaded once per request when `request` is given."""
+    resolver = permissions.get_resolver(request) if request is not None else permissions.PermissionResolver()
+    return resolver.can(course, user, action, participation=participation, submission=submission)
 
 
 def submission_is_allowed(task, user):
@@ -30,6 +34,27 @@ def submission_is_allowed(task, user):
     return task.daily_submission_limit and user_today_submissions.count() < daily_submission_limit
 
 
+def select_submissions(task, select='latest'):
+    """
+    One submission with a package per user: the latest one, or the best scoring one
+    (latest among ties) for select='best'.
+    """
+    submissions = task.submissions.exclude(file='').exclude(file__isnull=True)
+    if select == 'best':
+        candidates = submissions.filter(point__isnull=False).order_by('-point', '-created_at')
+    else:
+        candidates = submissions.order_by('-created_at')
+    chosen = candidates.filter(user=OuterRef('user')).values('pk')[:1]
+    return submissions.filter(pk=Subquery(chosen)).select_related('user').defer('notes').order_by('user__username')
+
+
+def export_submissions(task, select='latest'):
+    """Stream a zip file of the selected submissions, laid out as <username>/<package name>."""
+    entries = ((f"{s.user.username}/{s.filename or f'{s.pk}.zip'}", s.file.path if s.file else None)
+               for s in select_submissions(task, select).iterator())
+    return stream_zip_file(entries)
+
+
 def serialize_submission(s):
     return {
         'id': s.id,
@@ -98,10 +123,99 @@ def get_announcements():
         yield (announcement.text, 'alert-' + announcement.type)
 
 
+class BaseUrlRequest(HttpRequest):
+    """Request standing for settings.BASE_URL, to build absolute URLs outside of a request."""
+    def __init__(self, base_url):
+        super().__init__()
+        url = urlsplit(base_url)
+        self.META['HTTP_HOST'] = url.netloc
+        self._scheme = url.scheme or 'http'
+
+    def _get_scheme(self):
+        return self._scheme
+
+
+def get_base_request() -> HttpRequest:
+    return BaseUrlRequest(settings.BASE_URL)
+
+
+def _task_data_key(task, request):
+    return 'task-data:{}:{}:{}:{}://{}'.format(task.pk, task.updated_at.timestamp(), task.version_id,
+                                               request.scheme, request.get_host())
+
+
+def get_tasks_data(tasks, request) -> dict[int, dict]:
+    """
+    Serialized tasks by id. Payloads are cached per task state (updated_at and version, so
+    saving a task invalidates it) and per host, since they hold absolute URLs.
+    """
+    tasks = {task.pk: task for task in tasks}
+    keys = {_task_data_key(task, request): pk for pk, task in tasks.items()}
+    cached = cache.get_many(keys)
+    tasks_data = {keys[key]: data for key, data in cached.items()}
+
+    missing = {key: tasks[pk] for key, pk in keys.items() if key not in cached}
+    if missing:
+        serializer_context = {'request': request if isinstance(request, Request) else Request(request)}
+        serialized = {key: dict(TaskSerializer(task, context=serializer_context).data) for key, task in missing.items()}
+        cache.set_many(serialized, settings.TASK_DATA_CACHE_TIMEOUT)
+        tasks_data.update({keys[key]: data for key, data in serialized.items()})
+    return tasks_data
+
+
+def get_task_reference(task, request) -> dict:
+    """Compact stand-in for a task's payload, runners fetch the payload from `url` by version."""
+    return {
+        'id': task.pk,
+        'version': task.version_id,
+        'url': reverse('task-detail', args=(task.pk,), request=request),
+    }
+
+
 def submission_evaluate(request: HttpRequest, task: Task, submission: Submission):
+    submission.task = task
+    submissions_evaluate(request, [submission])
+
+
+def submissions_evaluate(request: HttpRequest, submissions):
+    """
+    Save the evaluation messages of queued submissions in the outbox (see app.outbox), or
+    complete them right away from a memo of identical evaluations (see app.memos).
+    """
+    submissions = list(submissions)
+    events.submissions_changed(submissions)
+
+    # Record the task version each submission is evaluated against, one update per task
+    task_versions, versions = {}, {}
+    for submission in submissions:
+        if submission.task.version_id is None: # Task saved before versioning, versioned once per task
+            if submission.task_id not in task_versions:
+                task_versions[submission.task_id] = Task.get_version_id(submission.task_id)
+            submission.task.version_id = task_versions[submission.task_id]
+        submission.task_version_id = submission.task.version_id
+        versions.setdefault(submission.task_version_id, []).append(submission.pk)
+    for version_id, pks in versions.items():
+        Submission.objects.filter(pk__in=pks).update(task_version_id=version_id)
+
+    hits = memos.apply(submissions)
+    if hits:
+        from .jobs import jobs_finished
+        hit_pks = {submission.pk for submission in hits}
+        transaction.on_commit(lambda: jobs_finished(hit_pks, memoized=True))
+        submissions = [submission for submission in submissions if submission.pk not in hit_pks]
+
     serializer_context = {
         'request': Request(request),
     }
-    task_data = TaskSerializer(task, context=serializer_context).data
-    submission_data = SubmissionSerializer(submission, context=serializer_context).data
-    celery_app.send_task('aicon_runner.tasks.evaluate', args=[task_data, submission_data])
+    tasks = {submission.task_id: submission.task for submission in submissions}
+    if settings.TASK_DATA_COMPACT:
+        tasks_data = {pk: get_task_reference(task, request) for pk, task in tasks.items()}
+    else:
+        tasks_data = get_tasks_data(tasks.values(), request)
+    messages = []
+    for submission, queue, priority in scheduler.plan(submissions):
+        submission_data = SubmissionSerializer(submission, context=serializer_context).data
+        messages.append(('aicon_runner.tasks.evaluate', [tasks_data[submission.task_id], submission_data],
+                         {'queue': queue, 'priority': priority}))
+    outbox.add(messages)
+    transaction.on_commit(lambda: queues.enqueued(submissions))
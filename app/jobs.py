@@ -0,0 +1,190 @@
+"""
+Job leasing for runners.
+
+A runner claims queued submissions in one request. The candidates are locked with
+`SELECT ... FOR UPDATE SKIP LOCKED` where the database supports it, so concurrent runners
+pick disjoint jobs instead of waiting on each other, and are moved to running with a
+conditional update tagged with a lease id, so a job is never handed to two runners.
+
+Results are applied in batches by `end_jobs`, and the finish hooks run once per batch.
+Runners extend their leases with heartbeats. Jobs whose lease expired (lost runner) are
+requeued by `reap_expired_jobs`, or errored out after JOB_MAX_ATTEMPTS claims.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from datetime import timedelta
+from .models import Submission, get_notes_summary
+from .funcs import get_base_request, submissions_evaluate
+from . import events, memos, outbox, queues, regrades, scheduler
+import json
+import secrets
+
+
+def lease_expiry(now=None):
+    return (now or timezone.now()) + timedelta(seconds=settings.JOB_LEASE_DURATION)
+
+
+def lease_fields():
+    """Fields of a newly claimed job."""
+    now = timezone.now()
+    return {
+        'status': Submission.STATUS_RUNNING,
+        'lease_id': secrets.token_hex(16),
+        'lease_expires_at': lease_expiry(now),
+        'started_at': now,
+        'attempts': F('attempts') + 1,
+    }
+
+
+def claimable_jobs(partitions=None, gpus=None):
+    """
+    Queued submissions, restricted to the given partition names (None for tasks without
+    partition) and to the tasks whose GPU requirement is in `gpus` (True for any, False or
+    an empty list for tasks without GPU).
+    """
+    jobs = Submission.objects.filter(status=Submission.STATUS_QUEUED)
+    if partitions is not None:
+        names = [name for name in partitions if name is not None]
+        condition = Q(task__partition__name__in=names)
+        if None in partitions:
+            condition |= Q(task__partition__isnull=True)
+        jobs = jobs.filter(condition)
+    if gpus is not None and gpus is not True:
+        condition = Q(task__gpus__isnull=True) | Q(task__gpus='')
+        if gpus:
+            condition |= Q(task__gpus__in=gpus)
+        jobs = jobs.filter(condition)
+    return jobs
+
+
+def claim_jobs(limit, partitions=None, gpus=None) -> list[Submission]:
+    """
+    Lease up to `limit` queued submissions to the caller in fair share order (see
+    app.scheduler) and mark them as running.
+    """
+    limit = max(0, min(limit, settings.JOB_CLAIM_MAX_LIMIT))
+    if not limit:
+        return []
+
+    # Window functions can't be combined with FOR UPDATE: rank the candidates first, then
+    # lock those not taken by another runner in the meantime.
+    candidates = list(scheduler.fair_order(claimable_jobs(partitions, gpus)).values_list('pk', flat=True)[:limit * 2])
+    if not candidates:
+        return []
+
+    fields = lease_fields()
+    with transaction.atomic():
+        locked = set(Submission.objects.filter(pk__in=candidates, status=Submission.STATUS_QUEUED)
+                                       .select_for_update(skip_locked=True).values_list('pk', flat=True))
+        pks = [pk for pk in candidates if pk in locked][:limit]
+        if not pks:
+            return []
+        Submission.objects.filter(pk__in=pks, status=Submission.STATUS_QUEUED).update(**fields)
+
+    jobs = Submission.objects.filter(lease_id=fields['lease_id']).select_related('task').in_bulk(pks)
+    queues.dequeued(list(jobs))
+    events.submissions_changed(jobs.values())
+    return [jobs[pk] for pk in pks if pk in jobs]
+
+
+def claim_job(pk) -> Submission | None:
+    """Lease one queued submission by id."""
+    claimed = Submission.objects.filter(pk=pk, status=Submission.STATUS_QUEUED).update(**lease_fields())
+    if not claimed:
+        return None
+    queues.dequeued([pk])
+    submission = Submission.objects.get(pk=pk)
+    events.submissions_changed([submission])
+    return submission
+
+
+def heartbeat(lease_ids) -> list[str]:
+    """Extend the given leases, return the ones still held (the others were reaped)."""
+    leased = Submission.objects.filter(status=Submission.STATUS_RUNNING, lease_id__in=lease_ids)
+    leased.update(lease_expires_at=lease_expiry())
+    return list(leased.values_list('lease_id', flat=True).distinct())
+
+
+def reap_expired_jobs(now=None) -> tuple[int, int]:
+    """
+    Requeue the running jobs whose lease expired, or error them out once they were claimed
+    JOB_MAX_ATTEMPTS times. Requeued jobs are sent to the runners again, errored ones run
+    the finish hooks like ended jobs.
+    Return the numbers of requeued and errored jobs.
+    """
+    now = now or timezone.now()
+    expired = Submission.objects.filter(status=Submission.STATUS_RUNNING, lease_expires_at__lt=now)
+    cleared = {'lease_id': None, 'lease_expires_at': None}
+    notes = json.dumps({'error': {'type': 'RunnerLost',
+                                  'message': f"Runner lost after {settings.JOB_MAX_ATTEMPTS} attempts."}})
+
+    with transaction.atomic():
+        lost = list(expired.filter(attempts__gte=settings.JOB_MAX_ATTEMPTS).values_list('pk', flat=True))
+        errored = expired.filter(pk__in=lost).update(
+            status=Submission.STATUS_ERROR,
+            notes=notes, notes_summary=get_notes_summary(notes), **cleared) if lost else 0
+        pks = list(expired.select_for_update(skip_locked=True).values_list('pk', flat=True))
+        requeued = expired.filter(pk__in=pks).update(status=Submission.STATUS_QUEUED, **cleared) if pks else 0
+        if requeued:
+            submissions = Submission.objects.filter(pk__in=pks, status=Submission.STATUS_QUEUED).select_related('task')
+            submissions_evaluate(get_base_request(), submissions)
+    if errored:
+        jobs_finished(lost)
+    return requeued, errored
+
+
+def end_jobs(results) -> tuple[list[int], list[int]]:
+    """
+    Apply validated job results (see serializers.JobResultSerializer) in one transaction,
+    updating only the given fields. Results of jobs that are not running, or whose lease
+    does not match, are rejected. Return the ended and rejected submission ids.
+    """
+    results = {result['id']: result for result in results}
+    ended, groups = [], {}
+    with transaction.atomic():
+        submissions = Submission.objects.select_for_update().filter(pk__in=results, status=Submission.STATUS_RUNNING) \
+                                        .only('pk', 'status', 'lease_id')
+        for submission in submissions:
+            result = results[submission.pk]
+            if result.get('lease_id') and result['lease_id'] != submission.lease_id:
+                continue
+            fields = ['status', 'lease_id', 'lease_expires_at']
+            for key in ('point', 'notes'):
+                if key in result:
+                    setattr(submission, key, result[key])
+                    fields.append(key)
+            if 'notes' in result:
+                submission.notes_summary = get_notes_summary(submission.notes)
+                fields.append('notes_summary')
+            submission.status = result['status']
+            submission.lease_id = None
+            submission.lease_expires_at = None
+            ended.append(submission)
+            # Grouped by updated fields, so that no deferred field is loaded
+            groups.setdefault(tuple(fields), []).append(submission)
+        for fields, group in groups.items():
+            Submission.objects.bulk_update(group, fields, batch_size=500)
+
+    ended_pks = [submission.pk for submission in ended]
+    if ended_pks:
+        jobs_finished(ended_pks)
+    return ended_pks, sorted(set(results) - set(ended_pks))
+
+
+def jobs_finished(pks, memoized=False):
+    """Hooks run once per batch of finished jobs."""
+    events.submissions_changed(pks=pks)
+
+    if not memoized:
+        memos.record(pks)
+
+    if settings.SIMILARITY_INDEX_ON_FINISH:
+        # Indexing is slow, it runs on the app's worker rather than in the runner's request
+        outbox.add([('app.tasks.index_submissions', [list(pks)], {})])
+
+    regrade_ids = set(Submission.objects.filter(pk__in=pks, regrade__isnull=False, regrade__finished_at__isnull=True)
+                                        .values_list('regrade_id', flat=True))
+    if regrade_ids:
+        regrades.advance_regrades(regrade_ids)
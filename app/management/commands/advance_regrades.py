@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from app.regrades import advance_regrades
+
+
+class Command(BaseCommand):
+    help = "Queue the next chunk of the regrade campaigns that have room for it."
+
+    def handle(self, *args, **options):
+        advance_regrades()
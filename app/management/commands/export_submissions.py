@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Task
+from app.funcs import export_submissions
+import sys
+
+
+class Command(BaseCommand):
+    help = "Export one submission package per user of a task into a zip file laid out by username."
+
+    def add_arguments(self, parser):
+        parser.add_argument('task_id', type=int)
+        parser.add_argument('--select', choices=['latest', 'best'], default='latest')
+        parser.add_argument('--output', help="Output zip file, defaults to stdout.")
+
+    def handle(self, *args, **options):
+        try:
+            task = Task.objects.get(pk=options['task_id'])
+        except Task.DoesNotExist:
+            raise CommandError(f"Task {options['task_id']} does not exist.")
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in export_submissions(task, options['select']):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
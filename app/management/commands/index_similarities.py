@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Task, Submission, Fingerprint, Similarity
+from app.similarity import index_submission
+
+
+class Command(BaseCommand):
+    help = "Fingerprint the finished submissions of a task and update its similarities."
+
+    def add_arguments(self, parser):
+        parser.add_argument('task_id', type=int)
+        parser.add_argument('--rebuild', action='store_true', help="Drop the task's index and similarities first.")
+
+    def handle(self, *args, **options):
+        try:
+            task = Task.objects.get(pk=options['task_id'])
+        except Task.DoesNotExist:
+            raise CommandError(f"Task {options['task_id']} does not exist.")
+
+        if options['rebuild']:
+            Fingerprint.objects.filter(task=task).delete()
+            Similarity.objects.filter(task=task).delete()
+
+        submissions = task.submissions.filter(status__in=[Submission.STATUS_DONE, Submission.STATUS_ERROR],
+                                              fingerprint__isnull=True).defer('notes').order_by('created_at')
+        count = 0
+        for submission in submissions.iterator():
+            index_submission(submission)
+            count += 1
+        self.stdout.write(f"Indexed {count} submission(s).")
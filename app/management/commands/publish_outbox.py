@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app import outbox
+import time
+
+
+class Command(BaseCommand):
+    help = "Send the messages of the outbox to the broker, in batches and with retries."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the outbox once and exit.")
+        parser.add_argument('--interval', type=float, default=settings.OUTBOX_PUBLISH_INTERVAL,
+                            help="Seconds between two drains.")
+        parser.add_argument('--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        while True:
+            sent = outbox.drain(batch_size=options['batch_size'])
+            if sent:
+                self.stdout.write(f"Sent {sent} message(s).")
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from app.jobs import reap_expired_jobs
+
+
+class Command(BaseCommand):
+    help = "Requeue or error out the running jobs whose runner lease expired."
+
+    def handle(self, *args, **options):
+        requeued, errored = reap_expired_jobs()
+        self.stdout.write(f"Requeued {requeued} job(s), errored out {errored} job(s).")
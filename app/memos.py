@@ -0,0 +1,75 @@
+"""
+Memo of evaluation results.
+
+The result of a successful evaluation is recorded under (task, task hash, submission package
+hash), where the task hash covers the task package and the settings the evaluation depends on
+(limits, GPUs and partition), so changing one of them invalidates the memos. They are taken
+from the TaskVersion the submission was evaluated against. A submission whose packages match
+a memo is completed with its point and notes instead of being queued. Tasks with
+non-deterministic evaluations opt out with Task.memoize.
+"""
+from django.db import connection
+from .models import EvaluationMemo, Submission, get_notes_summary
+import hashlib
+import json
+
+
+def task_hash(file_hash, run_time_limit, memory_limit, gpus, partition_id) -> str:
+    """Hash of a task package with the settings its evaluations depend on."""
+    data = json.dumps([file_hash, run_time_limit, memory_limit, gpus or None, partition_id])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _key(submission):
+    task = submission.task
+    return (submission.task_id, task_hash(task.file_hash, task.run_time_limit, task.memory_limit, task.gpus, task.partition_id),
+            submission.file_hash)
+
+
+def apply(submissions) -> list[Submission]:
+    """Complete the submissions that have a memo, return them."""
+    candidates = [s for s in submissions if s.task.memoize and s.task.file_hash and s.file_hash]
+    if not candidates:
+        return []
+
+    memos = EvaluationMemo.objects.filter(task_id__in={s.task_id for s in candidates},
+                                          submission_hash__in={s.file_hash for s in candidates})
+    memos = {(memo.task_id, memo.task_hash, memo.submission_hash): memo for memo in memos}
+
+    hits = []
+    for submission in candidates:
+        memo = memos.get(_key(submission))
+        if memo is None:
+            continue
+        submission.status = Submission.STATUS_DONE
+        submission.point = memo.point
+        submission.notes = memo.notes
+        submission.notes_summary = get_notes_summary(memo.notes)
+        submission.lease_id = None
+        submission.lease_expires_at = None
+        hits.append(submission)
+    Submission.objects.bulk_update(hits, ['status', 'point', 'notes', 'notes_summary', 'lease_id', 'lease_expires_at'])
+    return hits
+
+
+def record(pks):
+    """Record the results of the given finished submissions."""
+    # Keyed by the task version the submission was evaluated against, or the task for
+    # submissions evaluated before versioning
+    rows = Submission.objects.filter(pk__in=pks, status=Submission.STATUS_DONE, task__memoize=True, file_hash__isnull=False) \
+                             .values_list('task_id', 'task_version_id',
+                                          'task_version__file_hash', 'task_version__run_time_limit', 'task_version__memory_limit',
+                                          'task_version__gpus', 'task_version__partition_id',
+                                          'task__file_hash', 'task__run_time_limit', 'task__memory_limit',
+                                          'task__gpus', 'task__partition_id', 'file_hash', 'point', 'notes')
+    results = {}
+    for task_id, version_id, *fields, file_hash, point, notes in rows:
+        task_fields = fields[:5] if version_id is not None else fields[5:]
+        if task_fields[0]:
+            results[(task_id, task_hash(*task_fields), file_hash)] = (point, notes)
+    EvaluationMemo.objects.bulk_create(
+        [EvaluationMemo(task_id=task_id, task_hash=key_hash, submission_hash=file_hash, point=point, notes=notes)
+         for (task_id, key_hash, file_hash), (point, notes) in results.items()],
+        update_conflicts=True, update_fields=['point', 'notes'],
+        # MySQL resolves conflicts on any unique key and rejects an explicit target
+        unique_fields=['task', 'task_hash', 'submission_hash'] if connection.features.supports_update_conflicts_with_target else None)
@@ -0,0 +1,80 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:28
+
+import app.models
+from aicon.settings import SUBMISSION_BASE_MAIN_FILE, TASK_BASE_MAIN_FILE, TASK_BASE_SETUP_FILE
+from django.db import migrations, models
+import os
+import zipfile
+
+
+def read_package_manifest(file, main_file, text_files=()):
+    # Manifest as read when this migration was written, kept here so it doesn't follow app.models
+    if not file:
+        return None
+    try:
+        with zipfile.ZipFile(file.path, "r") as zipf:
+            infos = zipf.infolist()
+            texts = {}
+            for path in (main_file, *text_files):
+                try:
+                    texts[path] = zipf.read(path).decode("utf-8", errors="replace")
+                except KeyError:
+                    pass
+    except (OSError, zipfile.BadZipFile):
+        return None
+    if main_file not in texts:
+        return None
+    return {
+        'size': os.path.getsize(file.path),
+        'names': [info.filename for info in infos],
+        'sizes': {info.filename: info.file_size for info in infos},
+        'texts': texts,
+    }
+
+
+def build_package_manifests(apps, schema_editor):
+    Task = apps.get_model('app', 'Task')
+    Submission = apps.get_model('app', 'Submission')
+    for task in Task.objects.all():
+        task.file_manifest = read_package_manifest(task.file, TASK_BASE_MAIN_FILE, (TASK_BASE_SETUP_FILE,))
+        task.template_manifest = read_package_manifest(task.template, SUBMISSION_BASE_MAIN_FILE)
+        task.save(update_fields=['file_manifest', 'template_manifest'])
+    for submission in Submission.objects.exclude(file='').exclude(file__isnull=True).iterator():
+        submission.file_manifest = read_package_manifest(submission.file, SUBMISSION_BASE_MAIN_FILE)
+        submission.save(update_fields=['file_manifest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_remove_task_template_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='file_manifest',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='file_manifest',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='template_manifest',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='submission',
+            name='file',
+            field=app.models.ExtraFileField(blank=True, null=True, upload_to=app.models.submission_path),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='template',
+            field=app.models.ExtraFileField(blank=True, null=True, upload_to=app.models.task_path),
+        ),
+        migrations.RunPython(build_package_manifests, migrations.RunPython.noop),
+    ]
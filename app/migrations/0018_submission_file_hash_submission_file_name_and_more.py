@@ -0,0 +1,30 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:29
+
+import app.models
+import app.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_submission_file_manifest_task_file_manifest_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='file_name',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name='submission',
+            name='file',
+            field=app.models.ExtraFileField(blank=True, null=True, storage=app.storage.ContentAddressedStorage(), upload_to=app.models.submission_path),
+        ),
+    ]
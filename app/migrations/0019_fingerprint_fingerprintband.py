@@ -0,0 +1,37 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:34
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_submission_file_hash_submission_file_name_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Fingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signature', models.JSONField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('submission', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprint', to='app.submission')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprints', to='app.task')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FingerprintBand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32)),
+                ('fingerprint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bands', to='app.fingerprint')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.task')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['task', 'key'], name='app_fingerp_task_id_d9fc27_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_fingerprint_fingerprintband'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='lease_id',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='submission',
+            index=models.Index(fields=['status', 'created_at'], name='app_submiss_status_582981_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:45
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_regrade_submission_regrade'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='memoize',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.CreateModel(
+            name='EvaluationMemo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_hash', models.CharField(max_length=255)),
+                ('submission_hash', models.CharField(max_length=255)),
+                ('point', models.DecimalField(blank=True, decimal_places=3, max_digits=9, null=True)),
+                ('notes', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memos', to='app.task')),
+            ],
+            options={
+                'unique_together': {('task', 'task_hash', 'submission_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:46
+
+import app.storage
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_task_memoize_evaluationmemo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('file', models.FileField(storage=app.storage.ContentAddressedStorage(), upload_to='')),
+                ('file_hash', models.CharField(max_length=255)),
+                ('template', models.FileField(blank=True, null=True, storage=app.storage.ContentAddressedStorage(), upload_to='')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='app.task')),
+            ],
+            options={
+                'unique_together': {('task', 'number')},
+            },
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='task_version',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='submissions', to='app.taskversion'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='version',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.taskversion'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.1 on 2026-10-18 03:53
+
+from django.db import migrations, models
+import json
+import re
+
+
+def get_notes_summary(notes):
+    # Summary as computed when this migration was written, kept here so it doesn't follow app.models
+    if notes is None:
+        return {}
+    try:
+        data = json.loads(notes)
+    except Exception:
+        data = {}
+
+    def guess_error(notes):
+        notes = notes.replace('\\n',' ')
+        for er in ['Error', 'Exception', 'error']:
+            if er in notes:
+                return re.findall(r'(\w*%s\w*)' % er, notes)[-1] # return the last one
+
+    def make_space(text):
+        return re.sub(r'((?<=[a-z])[A-Z]|(?<!\A)[A-Z](?=[a-z]))', r' \1', text)
+
+    guessed_error = guess_error(notes)
+
+    if 'error' in data:
+        return {'error': make_space(data['error'].get('type', guessed_error or "Error"))}
+    return {'guessed_error': guessed_error}
+
+
+def build_notes_summaries(apps, schema_editor):
+    Submission = apps.get_model('app', 'Submission')
+    submissions = []
+    for submission in Submission.objects.only('pk', 'notes').iterator():
+        submission.notes_summary = get_notes_summary(submission.notes)
+        submissions.append(submission)
+        if len(submissions) >= 500:
+            Submission.objects.bulk_update(submissions, ['notes_summary'])
+            submissions = []
+    Submission.objects.bulk_update(submissions, ['notes_summary'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0025_taskversion_submission_task_version_task_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='notes_summary',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(build_notes_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.1 on 2026-10-18 09:12
+
+from django.db import migrations
+import zipfile
+
+
+def read_hashes(file):
+    # Hashes as read when this migration was written, kept here so it doesn't follow app.models
+    try:
+        with zipfile.ZipFile(file.path, "r") as zipf:
+            return {info.filename: f'{info.CRC:08x}' for info in zipf.infolist()}
+    except (OSError, zipfile.BadZipFile, ValueError):
+        return None
+
+
+def strip_manifest(manifest, file):
+    """Drop the stored sources from a manifest, they are read on demand."""
+    if manifest is None:
+        return None
+    manifest = {key: manifest[key] for key in ('size', 'names', 'sizes') if key in manifest}
+    hashes = read_hashes(file) if file else None
+    if hashes is not None:
+        manifest['hashes'] = hashes
+    return manifest
+
+
+def strip_package_manifests(apps, schema_editor):
+    Task = apps.get_model('app', 'Task')
+    Submission = apps.get_model('app', 'Submission')
+    for task in Task.objects.all():
+        task.file_manifest = strip_manifest(task.file_manifest, task.file)
+        task.template_manifest = strip_manifest(task.template_manifest, task.template)
+        task.save(update_fields=['file_manifest', 'template_manifest'])
+    submissions = []
+    for submission in Submission.objects.filter(file_manifest__isnull=False).only('pk', 'file', 'file_manifest').iterator():
+        submission.file_manifest = strip_manifest(submission.file_manifest, submission.file)
+        submissions.append(submission)
+        if len(submissions) >= 500:
+            Submission.objects.bulk_update(submissions, ['file_manifest'])
+            submissions = []
+    Submission.objects.bulk_update(submissions, ['file_manifest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_submission_notes_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(strip_package_manifests, migrations.RunPython.noop),
+    ]
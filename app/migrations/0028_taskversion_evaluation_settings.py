@@ -0,0 +1,46 @@
+# Generated by Django 5.1.1 on 2026-10-18 04:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_evaluation_settings(apps, schema_editor):
+    # Earlier versions didn't keep the settings, the current ones of their task are the best guess
+    TaskVersion = apps.get_model('app', 'TaskVersion')
+    for version in TaskVersion.objects.select_related('task'):
+        version.run_time_limit = version.task.run_time_limit
+        version.memory_limit = version.task.memory_limit
+        version.gpus = version.task.gpus
+        version.partition_id = version.task.partition_id
+        version.save(update_fields=['run_time_limit', 'memory_limit', 'gpus', 'partition'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_package_manifest_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskversion',
+            name='gpus',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='taskversion',
+            name='memory_limit',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='taskversion',
+            name='partition',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.partition'),
+        ),
+        migrations.AddField(
+            model_name='taskversion',
+            name='run_time_limit',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_evaluation_settings, migrations.RunPython.noop),
+    ]
@@ -1,19 +1,23 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from datetime import timedelta
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.shortcuts import reverse
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.core.serializers.json import DjangoJSONEncoder
 from aicon.settings import SUBMISSION_BASE_ZIPFILE, SUBMISSION_BASE_MAIN_DIR, SUBMISSION_BASE_MAIN_FILE, TASK_BASE_MAIN_FILE, TASK_BASE_SETUP_FILE
 from pathlib import Path
-from .utils import get_code, make_space, int_or_flot
+from .utils import get_code, get_zip_manifest, open_zip_members, make_space, int_or_flot
+from .storage import ContentAddressedStorage, package_storage
 import os
 import hashlib
 import json
 import re
 import secrets
 import zipfile
+from contextlib import contextmanager
 
 class ExtraFileField(models.FileField):
     def __init__(self, verbose_name=None, name=None, upload_to='', after_file_save=None, storage=None, **kwargs):
@@ -21,8 +25,12 @@ class ExtraFileField(models.FileField):
         super().__init__(verbose_name, name, upload_to=upload_to, storage=storage or default_storage, **kwargs)
 
     def pre_save(self, model_instance, add):
+        # Uploaded content before it is committed, upload handlers may have attached its digest
+        file = getattr(model_instance, self.attname)
+        content = file.file if file and not file._committed else None
         file = super().pre_save(model_instance, add)
-        self.after_file_save(model_instance)
+        if add or content is not None:
+            self.after_file_save(model_instance, content)
         return file
 
 def hash_file(file, block_size=65536):
@@ -56,6 +64,74 @@ def compute_file_hash(instance):
     with instance.file.open():
         instance.file_hash = hash_file(instance.file)
 
+def compute_task_file_metadata(instance, content=None):
+    digest = getattr(content, 'digest', None)
+    if digest is not None:
+        instance.file_hash = digest.md5
+    else:
+        compute_file_hash(instance)
+    instance.file_manifest = get_stored_manifest(instance.file, TASK_BASE_MAIN_FILE)
+    instance._packages_changed = True
+
+def compute_task_template_manifest(instance, content=None):
+    instance.template_manifest = get_stored_manifest(instance.template, SUBMISSION_BASE_MAIN_FILE)
+    instance._packages_changed = True
+
+def compute_submission_file_metadata(instance, content=None):
+    instance.file_hash = ContentAddressedStorage.digest(instance.file.name)
+    instance.file_manifest = get_stored_manifest(instance.file, SUBMISSION_BASE_MAIN_FILE)
+
+def get_package_manifest(file, main_file, text_files=()):
+    """
+    Return the (cached) manifest of a zip package, or None if the package doesn't exist,
+    is not a valid zip file or doesn't contain `main_file`.
+    """
+    if not file:
+        return None
+    manifest = get_zip_manifest(file.path, (main_file, *text_files))
+    if manifest is None or main_file not in manifest['texts']:
+        return None
+    return manifest
+
+def get_stored_manifest(file, main_file):
+    """
+    Manifest saved with a package: the archive size and the names, sizes and hashes of its
+    entries. Sources are left out, so that lists don't load them, see get_package_texts.
+    """
+    manifest = get_package_manifest(file, main_file)
+    if manifest is None:
+        return None
+    return {key: manifest[key] for key in ('size', 'names', 'sizes', 'hashes')}
+
+def get_package_texts(file, main_file, text_files=()) -> dict:
+    """Return the (cached) sources of `main_file` and `text_files` in a package, read on demand."""
+    manifest = get_package_manifest(file, main_file, text_files)
+    return manifest['texts'] if manifest else {}
+
+def get_notes_summary(notes):
+    """
+    Return what Submission.info shows of the evaluation notes: the error type of a failed
+    evaluation, or else the last error name found in the notes (None if there is none).
+    """
+    if notes is None:
+        return {}
+    try:
+        data = json.loads(notes)
+    except Exception:
+        data = {}
+
+    def guess_error(notes):
+        notes = notes.replace('\\n',' ')
+        for er in ['Error', 'Exception', 'error']:
+            if er in notes:
+                return re.findall(r'(\w*%s\w*)' % er, notes)[-1] # return the last one
+
+    guessed_error = guess_error(notes)
+
+    if 'error' in data:
+        return {'error': make_space(data['error'].get('type', guessed_error or "Error"))}
+    return {'guessed_error': guessed_error}
+
 
 class Course(models.Model):
     class Meta:
@@ -139,14 +215,18 @@ class Task(models.Model):
     DEFAULT_RUN_TIME_LIMIT = 60 # Second
     DEFAULT_MEMORY_LIMIT = 1048576 # KB
     DEFAULT_MAX_IMAGE_SIZE = 1048576 # KB
+    PACKAGE_DATE_TIME = (1980, 1, 1, 0, 0, 0) # Fixed entry timestamp, unchanged code keeps the package version
+    EVALUATION_SETTINGS = ('run_time_limit', 'memory_limit', 'gpus', 'partition_id') # Snapshot in TaskVersion
 
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
 
-    file = ExtraFileField(upload_to=task_path, after_file_save=compute_file_hash)
+    file = ExtraFileField(upload_to=task_path, after_file_save=compute_task_file_metadata)
     file_hash = models.CharField(max_length=255)
+    file_manifest = models.JSONField(blank=True, null=True, editable=False)
 
-    template = models.FileField(upload_to=task_path, blank=True, null=True)
+    template = ExtraFileField(upload_to=task_path, after_file_save=compute_task_template_manifest, blank=True, null=True)
+    template_manifest = models.JSONField(blank=True, null=True, editable=False)
 
     daily_submission_limit = models.PositiveSmallIntegerField(default=DEFAULT_DAILY_SUBMISSIONS_LIMIT)
     max_upload_size = models.IntegerField(default=DEFAULT_MAX_UPLOAD_SIZE)
@@ -158,6 +238,7 @@ class Task(models.Model):
     closed_at = models.DateTimeField(blank=True, null=True)
 
     leaderboard = models.BooleanField(default=False)
+    memoize = models.BooleanField(default=True)
 
     parent = models.ForeignKey('self', on_delete=models.CASCADE, related_name='subtasks', null=True)
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='tasks')
@@ -165,12 +246,59 @@ class Task(models.Model):
     partition = models.ForeignKey(Partition, on_delete=models.CASCADE, null=True, blank=True, related_name="tasks")
     gpus = models.CharField(max_length=255, null=True, blank=True)
 
+    version = models.ForeignKey('TaskVersion', on_delete=models.SET_NULL, blank=True, null=True, editable=False,
+                                related_name='+')
+
     created_at = models.DateTimeField(default=timezone.now)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return "{}".format(self.name)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if getattr(self, '_packages_changed', False) or self.version_id is None \
+                or self.version.evaluation_settings() != self.evaluation_settings():
+            self._packages_changed = False
+            self.create_version()
+
+    def evaluation_settings(self) -> dict:
+        return {field: getattr(self, field) for field in self.EVALUATION_SETTINGS}
+
+    def create_version(self):
+        """Snapshot the packages and evaluation settings as a new TaskVersion, unless they are unchanged."""
+        if not self.file:
+            return self.version
+        with self.file.open('rb'):
+            file_name = package_storage.save('task.zip', self.file)
+        template_name = None
+        if self.template:
+            with self.template.open('rb'):
+                template_name = package_storage.save('template.zip', self.template)
+
+        version = self.version
+        if version is not None and version.file.name == file_name and (version.template.name or None) == template_name \
+                and version.evaluation_settings() == self.evaluation_settings():
+            return version
+
+        number = (self.versions.aggregate(number=models.Max('number'))['number'] or 0) + 1
+        self.version = TaskVersion.objects.create(task=self, number=number, file=file_name, file_hash=self.file_hash,
+                                                  template=template_name, **self.evaluation_settings())
+        Task.objects.filter(pk=self.pk).update(version=self.version)
+        return self.version
+
+    @classmethod
+    def get_version_id(cls, pk):
+        """
+        Current version of a task, created for tasks saved before versioning. The task row
+        is locked so that concurrent callers create it once.
+        """
+        with transaction.atomic():
+            task = cls.objects.select_for_update().get(pk=pk)
+            if task.version_id is None:
+                task.create_version()
+            return task.version_id
+
     @property
     def deadline(self):
         if self.deadline_at:
@@ -204,23 +332,26 @@ class Task(models.Model):
     def file_url(self):
         return reverse('task_download', args=(self.course.pk,self.pk))
 
+    def get_file_manifest(self):
+        if self.file_manifest is not None:
+            return self.file_manifest
+        return get_stored_manifest(self.file, TASK_BASE_MAIN_FILE)
+
+    def get_template_manifest(self):
+        if self.template_manifest is not None:
+            return self.template_manifest
+        return get_stored_manifest(self.template, SUBMISSION_BASE_MAIN_FILE)
+
     @property
     def file_path(self):
-        if not self.file or not os.path.exists(self.file.path):
-            return None
-        try:
-            with zipfile.ZipFile(self.file.path, "r", zipfile.ZIP_DEFLATED) as zipf:
-                zipf.read(TASK_BASE_MAIN_FILE)
-            return self.file.path
-        except (zipfile.BadZipFile, KeyError):
+        if self.get_file_manifest() is None:
             return None
+        return self.file.path
 
     @property
     def file_content_names(self):
-        if self.file_path is None:
-            return []
-        with zipfile.ZipFile(self.file.path, "r", zipfile.ZIP_DEFLATED) as zipf:
-            return zipf.namelist()
+        manifest = self.get_file_manifest()
+        return manifest['names'] if manifest else []
 
     @property
     def file_contents(self):
@@ -228,33 +359,23 @@ class Task(models.Model):
 
     @property
     def code(self):
-        if self.file_path is None:
-            return ""
-        return get_code(self.file_path, TASK_BASE_MAIN_FILE)
+        return get_package_texts(self.file, TASK_BASE_MAIN_FILE, (TASK_BASE_SETUP_FILE,)).get(TASK_BASE_MAIN_FILE, "")
 
     @property
     def setup(self):
-        if self.file_path is None:
-            return ""
-        return get_code(self.file_path, TASK_BASE_SETUP_FILE)
+        texts = get_package_texts(self.file, TASK_BASE_MAIN_FILE, (TASK_BASE_SETUP_FILE,))
+        return texts.get(TASK_BASE_SETUP_FILE) if texts else ""
 
     @property
     def template_file_path(self):
-        if not self.template or not os.path.exists(self.template.path):
-            return None
-        try:
-            with zipfile.ZipFile(self.template.path, "r", zipfile.ZIP_DEFLATED) as zipf:
-                zipf.read(SUBMISSION_BASE_MAIN_FILE)
-            return self.template.path
-        except (zipfile.BadZipFile, KeyError):
+        if self.get_template_manifest() is None:
             return None
+        return self.template.path
 
     @property
     def template_file_content_names(self):
-        if self.template_file_path is None:
-            return []
-        with zipfile.ZipFile(self.template.path, "r", zipfile.ZIP_DEFLATED) as zipf:
-            return zipf.namelist()
+        manifest = self.get_template_manifest()
+        return manifest['names'] if manifest else []
 
     @property
     def template_file_contents(self):
@@ -262,9 +383,11 @@ class Task(models.Model):
 
     @property
     def template_code(self):
-        if self.template_file_path is None:
-            return ""
-        return get_code(self.template_file_path, SUBMISSION_BASE_MAIN_FILE)
+        return get_package_texts(self.template, SUBMISSION_BASE_MAIN_FILE).get(SUBMISSION_BASE_MAIN_FILE, "")
+
+    @property
+    def active_regrades(self):
+        return self.regrades.filter(finished_at__isnull=True).order_by('created_at')
 
     @property
     def partition_name(self):
@@ -282,10 +405,43 @@ class Task(models.Model):
         return "{} - {} AY{} Sem{}".format(self.name, self.course.code, self.course.academic_year, self.course.semester)
 
 
+class TaskVersion(models.Model):
+    """Immutable snapshot of a task's packages, stored by content so runners can cache them."""
+    class Meta:
+        unique_together = (('task', 'number'),)
+
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    file = models.FileField(storage=package_storage)
+    file_hash = models.CharField(max_length=255)
+    template = models.FileField(storage=package_storage, blank=True, null=True)
+
+    # Settings the evaluations depend on, as they were when the version was created
+    run_time_limit = models.IntegerField(blank=True, null=True)
+    memory_limit = models.IntegerField(blank=True, null=True)
+    gpus = models.CharField(max_length=255, null=True, blank=True)
+    partition = models.ForeignKey(Partition, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "{} v{}".format(self.task, self.number)
+
+    def evaluation_settings(self) -> dict:
+        return {field: getattr(self, field) for field in Task.EVALUATION_SETTINGS}
+
+
 class Submission(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['status', 'lease_expires_at']),
+        ]
+
     MAIN_DIR = SUBMISSION_BASE_MAIN_DIR
     MAIN_FILE = SUBMISSION_BASE_MAIN_FILE
     TEMPLATE_ZIP_FILE = SUBMISSION_BASE_ZIPFILE
+    PACKAGE_DATE_TIME = (1980, 1, 1, 0, 0, 0) # Fixed entry timestamp, identical code gives identical packages
 
     STATUS_QUEUED = 'Q'
     STATUS_RUNNING = 'R'
@@ -299,7 +455,11 @@ class Submission(models.Model):
     ]
 
     description = models.TextField(blank=True, null=True)
-    file = models.FileField(upload_to=submission_path, blank=True, null=True)
+    file = ExtraFileField(upload_to=submission_path, storage=package_storage, after_file_save=compute_submission_file_metadata,
+                          blank=True, null=True)
+    file_name = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    file_hash = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    file_manifest = models.JSONField(blank=True, null=True, editable=False)
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='submissions')
     task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='submissions')
@@ -311,6 +471,16 @@ class Submission(models.Model):
     )
     point = models.DecimalField(max_digits=9, decimal_places=3, blank=True, null=True)
     notes = models.TextField(blank=True, null=True)
+    notes_summary = models.JSONField(blank=True, null=True, editable=False)
+
+    lease_id = models.CharField(max_length=32, blank=True, null=True, editable=False, db_index=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True, editable=False)
+    started_at = models.DateTimeField(blank=True, null=True, editable=False)
+    attempts = models.PositiveSmallIntegerField(default=0, editable=False)
+    task_version = models.ForeignKey(TaskVersion, on_delete=models.SET_NULL, blank=True, null=True, editable=False,
+                                     related_name='submissions')
+    regrade = models.ForeignKey('Regrade', on_delete=models.SET_NULL, blank=True, null=True, editable=False,
+                                related_name='submissions')
 
     created_at = models.DateTimeField(default=timezone.now)
 
@@ -324,47 +494,59 @@ class Submission(models.Model):
 
     @property
     def filename(self):
-        return os.path.basename(self.file.name) if self.file else None
+        if not self.file:
+            return None
+        return self.file_name or os.path.basename(self.file.name)
 
     @property
     def file_url(self):
         return reverse('submission_download', args=(self.task.course.pk,self.task.pk, self.pk))
 
+    def get_file_manifest(self):
+        if self.file_manifest is not None:
+            return self.file_manifest
+        return get_stored_manifest(self.file, self.MAIN_FILE)
+
     @property
     def file_path(self):
-        if not self.file or not os.path.exists(self.file.path):
-            return None
-        try:
-            with zipfile.ZipFile(self.file.path, "r", zipfile.ZIP_DEFLATED) as zipf:
-                zipf.read(self.MAIN_FILE)
-            return self.file.path
-        except (zipfile.BadZipFile, KeyError):
+        if self.get_file_manifest() is None:
             return None
+        return self.file.path
 
     @property
     def file_size(self):
+        if self.file_manifest is not None:
+            return self.file_manifest['size']
         try:
             return self.file.size
         except:
             return None
 
+    @contextmanager
+    def open_files(self, names=None):
+        """
+        Lazily iterate the package members (or only `names`) as streaming `File` objects,
+        opening the package once. Each file can only be read until the next one is requested.
+
+            with submission.open_files() as files:
+                for f in files:
+                    ...
+        """
+        if self.file_path is None:
+            yield iter(())
+            return
+        with open_zip_members(self.file_path, names) as members:
+            yield (File(f, name=filename) for filename, f in members)
+
     @property
     def files(self):
-        if self.file_path is None:
-            return []
-        with zipfile.ZipFile(self.file_path, "r", zipfile.ZIP_DEFLATED) as zipf:
-            files = []
-            for filename in self.file_content_names:
-                with zipf.open(filename, 'r') as f:
-                    files.append(ContentFile(f.read(), name=filename))
-            return files
+        with self.open_files() as files:
+            return [ContentFile(f.read(), name=f.name) for f in files]
 
     @property
     def file_content_names(self):
-        if self.file_path is None:
-            return []
-        with zipfile.ZipFile(self.file.path, "r", zipfile.ZIP_DEFLATED) as zipf:
-            return zipf.namelist()
+        manifest = self.get_file_manifest()
+        return manifest['names'] if manifest else []
 
     @property
     def file_contents(self):
@@ -372,34 +554,42 @@ class Submission(models.Model):
 
     @property
     def code(self):
-        if self.file_path is None:
-            return ""
-        return self.get_code(self.file_path)
+        return get_package_texts(self.file, self.MAIN_FILE).get(self.MAIN_FILE, "")
 
     @property
-    def info(self):
-        try:
-            data = json.loads(self.notes)
-        except Exception:
-            data = {}
-
-        def guess_error(notes):
-            notes = notes.replace('\\n',' ')
-            for er in ['Error', 'Exception', 'error']:
-                if er in notes:
-                    return re.findall(r'(\w*%s\w*)' % er, notes)[-1] # return the last one
+    def evaluation_version(self):
+        """Changes whenever the evaluation can change: on state changes and reruns."""
+        started_at = int(self.started_at.timestamp()) if self.started_at else 0
+        return f'{self.status}-{started_at}-{self.task_version_id or 0}'
 
-        additional_error = guess_error(self.notes) if self.notes is not None else None
+    @property
+    def info(self):
+        # Summary stored with the notes, so that lists can defer them
+        summary = self.notes_summary
+        if summary is None:
+            summary = get_notes_summary(self.notes)
 
-        if 'error' in data:
-            return make_space(data['error'].get('type', additional_error or "Error"))
+        if 'error' in summary:
+            return summary['error']
 
+        guessed_error = summary.get('guessed_error')
         return str(int_or_flot(self.point) if self.point is not None else "N/A") + \
-               (f" ({make_space(additional_error)})" if additional_error is not None else "")
+               (f" ({make_space(guessed_error)})" if guessed_error is not None else "")
+
+    @property
+    def queue_position(self):
+        if not hasattr(self, '_queue_position'):
+            from .queues import get_position
+            self._queue_position = get_position(self)
+        return self._queue_position
 
     @property
     def queue(self):
-        return Submission.objects.filter(status=Submission.STATUS_QUEUED, created_at__lte=self.created_at).count()
+        return self.queue_position[0] if self.queue_position else None
+
+    @property
+    def partition_queue(self):
+        return self.queue_position[1] if self.queue_position else None
 
     @property
     def is_late(self):
@@ -420,6 +610,16 @@ class Submission(models.Model):
                 texts.append(suggestion.text)
         return texts
 
+    def save(self, *args, **kwargs):
+        # Packages are stored by content, keep the uploaded name for display and downloads
+        if self.file and not self.file._committed:
+            self.file_name = os.path.basename(self.file.name)
+        if 'notes' not in self.get_deferred_fields():
+            self.notes_summary = get_notes_summary(self.notes)
+            if kwargs.get('update_fields') is not None and 'notes' in kwargs['update_fields']:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'notes_summary'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return "{}:{} - {} - {} AY{} Sem{}".format(self.user, self.pk, self.task.name,
             self.task.course.code, self.task.course.academic_year, self.task.course.semester)
@@ -437,6 +637,77 @@ class Similarity(models.Model):
     diff = models.TextField(blank=True, null=True)
 
 
+class Fingerprint(models.Model):
+    """MinHash signature of a submission's code, see app.similarity."""
+    submission = models.OneToOneField(Submission, on_delete=models.CASCADE, related_name='fingerprint')
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='fingerprints')
+    signature = models.JSONField()
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class FingerprintBand(models.Model):
+    """LSH band of a fingerprint, submissions sharing a band key are candidate neighbours."""
+    class Meta:
+        indexes = [models.Index(fields=['task', 'key'])]
+
+    fingerprint = models.ForeignKey(Fingerprint, on_delete=models.CASCADE, related_name='bands')
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=32)
+
+
+class EvaluationMemo(models.Model):
+    """Result of evaluating a submission package against a task package, see app.memos."""
+    class Meta:
+        unique_together = (('task', 'task_hash', 'submission_hash'),)
+
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='memos')
+    task_hash = models.CharField(max_length=255) # Task package and evaluation settings, see app.memos.task_hash
+    submission_hash = models.CharField(max_length=255)
+    point = models.DecimalField(max_digits=9, decimal_places=3, blank=True, null=True)
+    notes = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class Regrade(models.Model):
+    """Rerun of many submissions, dispatched in throttled chunks by app.regrades."""
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, blank=True, null=True, related_name='regrades')
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+
+    total = models.PositiveIntegerField(default=0)
+    dispatched = models.PositiveIntegerField(default=0)
+    cursor = models.PositiveIntegerField(default=0) # Submissions are dispatched by increasing pk
+
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    @cached_property
+    def done(self):
+        return self.submissions.filter(pk__lte=self.cursor) \
+                               .exclude(status__in=[Submission.STATUS_QUEUED, Submission.STATUS_RUNNING]).count()
+
+    @property
+    def progress(self):
+        return round(100 * self.done / self.total) if self.total else 100
+
+
+class OutboxMessage(models.Model):
+    """Celery message saved in the transaction that triggers it and sent later, see app.outbox."""
+    class Meta:
+        indexes = [models.Index(fields=['available_at', 'id'])]
+
+    name = models.CharField(max_length=255)
+    args = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    options = models.JSONField(default=dict)
+
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    available_at = models.DateTimeField(default=timezone.now)
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+
 class Announcement(models.Model):
     TYPE_SUCCESS = 'success'
     TYPE_INFO = 'info'
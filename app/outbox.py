@@ -0,0 +1,74 @@
+"""
+Transactional outbox for Celery messages.
+
+Messages are saved as OutboxMessage rows in the same transaction as the data they refer to,
+so a request never waits on the broker and a message exists if and only if its transaction
+committed. `publish` sends them in batches (publish_outbox command or Celery beat) and
+retries failed ones with an exponential backoff.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from datetime import timedelta
+from aicon.celery import app as celery_app
+from .models import OutboxMessage
+
+
+class MemoryBroker:
+    """Stand-in for the Celery app that keeps the messages in memory instead of sending them."""
+    def __init__(self):
+        self.messages = []
+
+    def send_task(self, name, args=None, **options):
+        self.messages.append((name, args, options))
+
+
+def add(messages):
+    """Save `(name, args, options)` messages, to be called inside the caller's transaction."""
+    OutboxMessage.objects.bulk_create([OutboxMessage(name=name, args=args, options=options)
+                                       for name, args, options in messages])
+
+
+def retry_delay(attempts) -> timedelta:
+    return timedelta(seconds=min(settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), settings.OUTBOX_MAX_RETRY_DELAY))
+
+
+def publish(broker=None, batch_size=None) -> tuple[int, bool]:
+    """
+    Send one batch of due messages, oldest first. Sent messages are deleted. The batch stops
+    at the first failure (the broker is likely down), the failed message is retried later.
+    Return the number of sent messages and whether a send failed.
+    """
+    broker = broker or celery_app
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    now = timezone.now()
+
+    with transaction.atomic():
+        messages = OutboxMessage.objects.select_for_update(skip_locked=True) \
+                                        .filter(available_at__lte=now).order_by('available_at', 'pk')[:batch_size]
+        sent, failed = [], None
+        for message in messages:
+            try:
+                broker.send_task(message.name, args=message.args, **message.options)
+            except Exception as e:
+                failed = message
+                failed.attempts += 1
+                failed.last_error = repr(e)
+                failed.available_at = now + retry_delay(failed.attempts)
+                failed.save(update_fields=['attempts', 'last_error', 'available_at'])
+                break
+            sent.append(message.pk)
+        OutboxMessage.objects.filter(pk__in=sent).delete()
+
+    return len(sent), failed is not None
+
+
+def drain(broker=None, batch_size=None) -> int:
+    """Publish batches until no due message is left or a send fails, return the number sent."""
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    total = 0
+    while True:
+        sent, failed = publish(broker, batch_size)
+        total += sent
+        if failed or sent < batch_size:
+            return total
@@ -0,0 +1,60 @@
+"""
+Request-scoped permission checks.
+
+The actions a role allows (settings.ROLES) are kept as a bitmask per role. A
+PermissionResolver loads the roles of a course once: the role of the checked user together
+with those of all staff (roles allowed to edit tasks). Staff-only checks of other users,
+e.g. excluding staff from a leaderboard, are then answered without more queries.
+"""
+from django.conf import settings
+from django.db.models import Q
+from .models import Participation
+
+ACTIONS = {action: 1 << i for i, action in enumerate(settings.ROLES)}
+ROLE_ACTIONS = {role: sum(bit for action, bit in ACTIONS.items() if role in settings.ROLES[action])
+                for role in {role for roles in settings.ROLES.values() for role in roles}}
+STAFF_ROLES = set(settings.ROLES['task.edit'])
+STAFF_ACTIONS = sum(bit for action, bit in ACTIONS.items() if set(settings.ROLES[action]) <= STAFF_ROLES)
+
+
+def allows(role, action) -> bool:
+    return bool(ROLE_ACTIONS.get(role, 0) & ACTIONS[action])
+
+
+class PermissionResolver:
+    def __init__(self):
+        self._roles = {}  # Course id -> {user id: role}, of the users looked up and all staff
+        self._users = {}  # Course id -> ids of the users looked up
+
+    def role(self, course, user, action=None):
+        """
+        Role of a user in a course, None if not participating. Users other than the ones
+        already looked up are known to be non-staff, which is enough for staff-only actions.
+        """
+        roles = self._roles.get(course.pk)
+        if roles is None:
+            roles = self._roles[course.pk] = dict(
+                Participation.objects.filter(Q(user_id=user.pk) | Q(role__in=STAFF_ROLES), course_id=course.pk)
+                                     .values_list('user_id', 'role'))
+            self._users[course.pk] = {user.pk}
+        elif user.pk not in roles and user.pk not in self._users[course.pk] \
+                and (action is None or ACTIONS[action] & ~STAFF_ACTIONS):
+            role = Participation.objects.filter(user_id=user.pk, course_id=course.pk).values_list('role', flat=True).first()
+            if role is not None:
+                roles[user.pk] = role
+            self._users[course.pk].add(user.pk)
+        return roles.get(user.pk)
+
+    def can(self, course, user, action, participation=None, submission=None) -> bool:
+        if submission and submission.user_id == user.pk:
+            return True
+        if participation:
+            return allows(participation.role, action)
+        return allows(self.role(course, user, action), action)
+
+
+def get_resolver(request) -> PermissionResolver:
+    """The resolver of a request, created on first use."""
+    if not hasattr(request, '_permission_resolver'):
+        request._permission_resolver = PermissionResolver()
+    return request._permission_resolver
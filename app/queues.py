@@ -0,0 +1,114 @@
+"""
+Queue positions of queued submissions.
+
+The queue is kept in the cache as a list of `(created_at, pk, partition_id)` entries in queue
+order, together with a version. It is updated incrementally when submissions are enqueued
+(`enqueued`) and leave the queue (`dequeued`). Incremental updates are not atomic across
+processes, so the queue is rebuilt from the database when missing or when it was built more
+than `QUEUE_POSITIONS_TIMEOUT` ago, however often it was updated since, which heals
+concurrent updates.
+Each process computes the ranks of one version once, so a position costs one cache read.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from .models import Submission
+import bisect
+import math
+import threading
+import time
+
+QUEUE_KEY = 'queue:entries'
+VERSION_KEY = 'queue:version'
+
+_ranks = {'version': None, 'ranks': {}}
+_ranks_lock = threading.Lock()
+
+
+def _entry(submission):
+    return (submission.created_at.timestamp(), submission.pk, submission.task.partition_id)
+
+
+def _build() -> list[tuple]:
+    rows = Submission.objects.filter(status=Submission.STATUS_QUEUED) \
+                             .values_list('created_at', 'pk', 'task__partition_id')
+    return sorted((created_at.timestamp(), pk, partition_id) for created_at, pk, partition_id in rows)
+
+
+def _is_stale(built_at) -> bool:
+    return time.time() - built_at >= settings.QUEUE_POSITIONS_TIMEOUT
+
+
+def _store(entries: list[tuple], built_at=None) -> int:
+    """Store entries built at `built_at` (now if None), they expire with the build."""
+    now = time.time()
+    built_at = now if built_at is None else built_at
+    version = time.time_ns()
+    cache.set_many({QUEUE_KEY: {'version': version, 'entries': entries, 'built_at': built_at}, VERSION_KEY: version},
+                   max(1, math.ceil(built_at + settings.QUEUE_POSITIONS_TIMEOUT - now)))
+    return version
+
+
+def _rank(entries: list[tuple]) -> dict[int, tuple[int, int]]:
+    """Map each queued submission to its 1-based (global, partition) position."""
+    ranks = {}
+    partitions = {}
+    for position, (_, pk, partition_id) in enumerate(entries, start=1):
+        partitions[partition_id] = partitions.get(partition_id, 0) + 1
+        ranks[pk] = (position, partitions[partition_id])
+    return ranks
+
+
+def get_version():
+    """Version of the queue, changed whenever positions can change. None until it is rebuilt."""
+    return cache.get(VERSION_KEY)
+
+
+def get_ranks(rebuild=False) -> dict[int, tuple[int, int]]:
+    version = None if rebuild else cache.get(VERSION_KEY)
+    with _ranks_lock:
+        if version is not None and version == _ranks['version']:
+            return _ranks['ranks']
+        data = cache.get(QUEUE_KEY) if version is not None else None
+        if data is None or data['version'] != version or _is_stale(data['built_at']):
+            entries = _build()
+            version = _store(entries)
+        else:
+            entries = data['entries']
+        _ranks['version'] = version
+        _ranks['ranks'] = _rank(entries)
+        return _ranks['ranks']
+
+
+def get_position(submission) -> tuple[int, int] | None:
+    """Return the (global, partition) queue position of a queued submission."""
+    if submission.status != Submission.STATUS_QUEUED:
+        return None
+    position = get_ranks().get(submission.pk)
+    if position is None: # Enqueued elsewhere without the index being updated
+        position = get_ranks(rebuild=True).get(submission.pk)
+    return position
+
+
+def _update(remove=(), add=()):
+    data = cache.get(QUEUE_KEY)
+    if data is None or _is_stale(data['built_at']): # Rebuilt on the next read
+        return
+    remove = set(remove) | {entry[1] for entry in add}
+    entries = [entry for entry in data['entries'] if entry[1] not in remove]
+    for entry in add:
+        bisect.insort(entries, entry)
+    _store(entries, data['built_at'])
+
+
+def enqueued(submissions):
+    """Add submissions that were (re)queued."""
+    _update(add=[_entry(submission) for submission in submissions])
+
+
+def dequeued(pks):
+    """Remove submissions that left the queue."""
+    _update(remove=pks)
+
+
+def invalidate():
+    cache.delete_many([QUEUE_KEY, VERSION_KEY])
@@ -0,0 +1,74 @@
+"""
+Bulk reruns and task-wide regrades.
+
+Small reruns are queued at once. Larger ones become a Regrade campaign: its submissions are
+queued by increasing pk, one chunk of REGRADE_CHUNK_SIZE at a time while fewer than
+REGRADE_MAX_IN_FLIGHT of them are queued or running. Campaigns advance when their jobs finish
+and periodically (Celery beat or the advance_regrades command).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Participation, Regrade, Submission
+from .funcs import get_base_request, submissions_evaluate
+
+IN_FLIGHT = [Submission.STATUS_QUEUED, Submission.STATUS_RUNNING]
+
+
+def rerun_denied(user, submissions) -> list[int]:
+    """Ids of the submissions the user is not allowed to rerun, checked with two queries."""
+    rows = list(submissions.values_list('pk', 'user_id', 'task__course_id'))
+    roles = dict(Participation.objects.filter(user=user, course_id__in={course_id for _, _, course_id in rows})
+                                      .values_list('course_id', 'role'))
+    return sorted(pk for pk, user_id, course_id in rows
+                  if user_id != user.pk and roles.get(course_id) not in settings.ROLES['submission.rerun'])
+
+
+def requeue(request, submissions):
+    submissions.update(status=Submission.STATUS_QUEUED, attempts=0, lease_id=None, lease_expires_at=None)
+    submissions_evaluate(request, submissions.select_related('task'))
+
+
+def rerun(request, submissions, task=None) -> Regrade | None:
+    """Rerun submissions, through a Regrade campaign for a task or a large selection."""
+    total = submissions.count()
+    if task is None and total <= settings.REGRADE_CHUNK_SIZE:
+        with transaction.atomic():
+            requeue(request, submissions)
+        return None
+
+    with transaction.atomic():
+        regrade = Regrade.objects.create(task=task, user=request.user, total=total)
+        submissions.update(regrade=regrade)
+    return advance(regrade, request)
+
+
+def advance(regrade, request=None) -> Regrade:
+    """Queue the next chunk of a campaign if it has room, and close it once everything ran."""
+    with transaction.atomic():
+        regrade = Regrade.objects.select_for_update().get(pk=regrade.pk)
+        if regrade.finished_at is not None:
+            return regrade
+
+        in_flight = regrade.submissions.filter(pk__lte=regrade.cursor, status__in=IN_FLIGHT).count()
+        room = min(settings.REGRADE_CHUNK_SIZE, settings.REGRADE_MAX_IN_FLIGHT - in_flight)
+        if room > 0:
+            chunk = list(regrade.submissions.filter(pk__gt=regrade.cursor).order_by('pk').values_list('pk', flat=True)[:room])
+            if chunk:
+                requeue(request or get_base_request(), Submission.objects.filter(pk__in=chunk))
+                regrade.cursor = chunk[-1]
+                regrade.dispatched += len(chunk)
+                in_flight += len(chunk)
+
+        if not in_flight and not regrade.submissions.filter(pk__gt=regrade.cursor).exists():
+            regrade.finished_at = timezone.now()
+        regrade.save(update_fields=['cursor', 'dispatched', 'finished_at'])
+    return regrade
+
+
+def advance_regrades(regrade_ids=None):
+    regrades = Regrade.objects.filter(finished_at__isnull=True)
+    if regrade_ids is not None:
+        regrades = regrades.filter(pk__in=regrade_ids)
+    for regrade in regrades:
+        advance(regrade)
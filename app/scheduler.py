@@ -0,0 +1,86 @@
+"""
+Dispatch scheduling of submissions.
+
+With SCHEDULER_ROUTE_QUEUES, evaluations are routed to one Celery queue per partition, with a
+`.gpu` suffix for tasks requiring GPUs, so runners subscribe to the queues they can serve and
+one kind of task does not hold up the others. It is off by default, as current runners only
+consume the default queue.
+
+Queued submissions are ordered by fair share rather than FIFO: the n-th queued submission
+of a user (and of a task) gets a share of n * SCHEDULER_USER_WEIGHT (+ m * SCHEDULER_TASK_WEIGHT)
+and lower shares go first, so a user queueing many submissions only delays their own.
+Runners claiming jobs get them in this order, pushed evaluations get it as message priority.
+"""
+from django.conf import settings
+from django.db.models import Count, F, FloatField, Value, Window
+from django.db.models.functions import RowNumber
+from .models import Submission
+import math
+
+QUEUE_SEPARATOR = '.'
+GPU_QUEUE_SUFFIX = 'gpu'
+
+
+def route(task) -> str:
+    """Celery queue of a task's evaluations."""
+    if not settings.SCHEDULER_ROUTE_QUEUES:
+        return settings.SCHEDULER_DEFAULT_QUEUE
+    parts = [settings.SCHEDULER_DEFAULT_QUEUE]
+    if task.partition_id is not None:
+        parts.append(task.partition_name)
+    if task.gpus:
+        parts.append(GPU_QUEUE_SUFFIX)
+    return QUEUE_SEPARATOR.join(parts)
+
+
+def share(user_rank, task_rank) -> float:
+    return user_rank * settings.SCHEDULER_USER_WEIGHT + task_rank * settings.SCHEDULER_TASK_WEIGHT
+
+
+def priority(share_value) -> int:
+    """
+    Message priority for a fair share (lower first). Uses the AMQP convention (higher first),
+    queues must be declared with `x-max-priority` for it to take effect.
+    """
+    max_priority = settings.SCHEDULER_MAX_PRIORITY
+    return max(0, min(max_priority, max_priority + 1 - math.floor(share_value)))
+
+
+def fair_order(jobs):
+    """Order a queryset of queued submissions by fair share, then by age."""
+    rank_order = [F('created_at').asc(), F('pk').asc()]
+    return jobs.annotate(
+        user_rank=Window(RowNumber(), partition_by=[F('user_id')], order_by=rank_order),
+        task_rank=Window(RowNumber(), partition_by=[F('task_id')], order_by=rank_order),
+    ).annotate(
+        share=F('user_rank') * Value(settings.SCHEDULER_USER_WEIGHT, output_field=FloatField()) +
+              F('task_rank') * Value(settings.SCHEDULER_TASK_WEIGHT, output_field=FloatField()),
+    ).order_by('share', 'created_at', 'pk')
+
+
+def plan(submissions) -> list[tuple[Submission, str, int]]:
+    """
+    Return `(submission, queue, priority)` for submissions that were just queued, in fair
+    order. Their ranks follow the submissions each user and task already has queued.
+    """
+    submissions = list(submissions)
+    if not submissions:
+        return []
+    queued = Submission.objects.filter(status=Submission.STATUS_QUEUED).exclude(pk__in=[s.pk for s in submissions])
+    user_ranks = dict(queued.filter(user_id__in={s.user_id for s in submissions})
+                            .values_list('user_id').annotate(count=Count('pk')).order_by())
+    task_ranks = dict(queued.filter(task_id__in={s.task_id for s in submissions})
+                            .values_list('task_id').annotate(count=Count('pk')).order_by())
+
+    planned = []
+    routes = {}
+    for submission in sorted(submissions, key=lambda s: (s.created_at, s.pk)):
+        user_ranks[submission.user_id] = user_ranks.get(submission.user_id, 0) + 1
+        task_ranks[submission.task_id] = task_ranks.get(submission.task_id, 0) + 1
+        if submission.task_id not in routes:
+            routes[submission.task_id] = route(submission.task)
+        value = share(user_ranks[submission.user_id], task_ranks[submission.task_id])
+        planned.append((value, submission, routes[submission.task_id]))
+
+    planned.sort(key=lambda item: item[0])
+    return [(submission, queue, priority(value)) for value, submission, queue in planned]
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from rest_framework.reverse import reverse
 from .models import Submission, Task, Similarity, User
+import decimal
 
 class SubmissionSerializer(serializers.HyperlinkedModelSerializer):
     file_url = serializers.HyperlinkedIdentityField('submission-download', read_only=True)
@@ -8,12 +9,43 @@ class SubmissionSerializer(serializers.HyperlinkedModelSerializer):
         model = Submission
         fields = ('id', 'file_url', 'status', 'point', 'notes', 'task')
 
+class JobSerializer(SubmissionSerializer):
+    class Meta(SubmissionSerializer.Meta):
+        fields = SubmissionSerializer.Meta.fields + ('lease_id', 'lease_expires_at')
+
+class QuantizedDecimalField(serializers.DecimalField):
+    """Round extra decimal places, as saving the model field does, instead of rejecting them."""
+    def validate_precision(self, value):
+        if value.is_finite():
+            value = value.quantize(decimal.Decimal(1).scaleb(-self.decimal_places), rounding=decimal.ROUND_HALF_EVEN)
+        return super().validate_precision(value)
+
+class JobResultSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    lease_id = serializers.CharField(required=False)
+    status = serializers.ChoiceField(choices=[Submission.STATUS_DONE, Submission.STATUS_ERROR])
+    point = QuantizedDecimalField(max_digits=9, decimal_places=3, required=False, allow_null=True)
+    notes = serializers.CharField(required=False, allow_null=True, allow_blank=True, trim_whitespace=False)
+
 class TaskSerializer(serializers.HyperlinkedModelSerializer):
     file_url = serializers.HyperlinkedIdentityField('task-download', read_only=True)
     template_url = serializers.HyperlinkedIdentityField('task-template-download', read_only=True)
+    version = serializers.PrimaryKeyRelatedField(read_only=True)
+    version_file_url = serializers.SerializerMethodField()
+    version_template_url = serializers.SerializerMethodField()
     class Meta:
         model = Task
-        fields = ('id', 'name', 'description', 'file_url', 'file_hash', 'template_url', 'daily_submission_limit', 'max_upload_size', 'partition_name', 'gpus', 'run_time_limit', 'memory_limit', 'opened_at', 'closed_at', 'leaderboard')
+        fields = ('id', 'name', 'description', 'file_url', 'file_hash', 'template_url', 'version', 'version_file_url', 'version_template_url', 'daily_submission_limit', 'max_upload_size', 'partition_name', 'gpus', 'run_time_limit', 'memory_limit', 'opened_at', 'closed_at', 'leaderboard')
+
+    def get_version_file_url(self, task):
+        if task.version_id is None:
+            return None
+        return reverse('task-version-download', args=(task.pk, task.version_id), request=self.context.get('request'))
+
+    def get_version_template_url(self, task):
+        if task.version_id is None or not task.version.template:
+            return None
+        return reverse('task-version-template-download', args=(task.pk, task.version_id), request=self.context.get('request'))
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,126 @@
+"""
+Submission similarity engine.
+
+Each submission's code is reduced to token shingles (minus the shingles of the task
+template), fingerprinted with a MinHash signature and indexed per task with locality
+sensitive hashing (LSH): the signature is split into bands and each band's hash is stored.
+A new submission is only compared with the submissions sharing at least one band with it,
+instead of every submission of the task.
+"""
+from django.conf import settings
+from django.db import transaction
+from .models import Similarity, Fingerprint, FingerprintBand, Submission
+import difflib
+import hashlib
+import io
+import random
+import re
+import tokenize
+
+SHINGLE_SIZE = 5 # Tokens
+NUM_PERM = 128
+BANDS = 32 # NUM_PERM / BANDS rows per band, candidates from ~0.4 similarity
+ROWS = NUM_PERM // BANDS
+
+_PRIME = (1 << 61) - 1
+_random = random.Random(4246)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+_SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.ENCODING, tokenize.ENDMARKER}
+
+
+def _hash64(data: str) -> int:
+    return int.from_bytes(hashlib.blake2b(data.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def tokens(code: str) -> list[str]:
+    try:
+        return [t.string or tokenize.tok_name[t.type] for t in tokenize.generate_tokens(io.StringIO(code).readline)
+                if t.type not in _SKIPPED_TOKENS]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return re.findall(r"\w+|[^\w\s]", code)
+
+
+def shingles(code: str | None) -> set[int]:
+    if not code:
+        return set()
+    ts = tokens(code)
+    if len(ts) < SHINGLE_SIZE:
+        return {_hash64(" ".join(ts))} if ts else set()
+    return {_hash64(" ".join(ts[i:i + SHINGLE_SIZE])) for i in range(len(ts) - SHINGLE_SIZE + 1)}
+
+
+def minhash(values: set[int]) -> list[int] | None:
+    if not values:
+        return None
+    return [min((a * v + b) % _PRIME for v in values) for a, b in _PERMUTATIONS]
+
+
+def band_keys(signature: list[int]) -> list[str]:
+    return ["{}:{:016x}".format(band, _hash64(",".join(map(str, signature[band * ROWS:(band + 1) * ROWS]))))
+            for band in range(BANDS)]
+
+
+def estimate_similarity(signature: list[int], other: list[int]) -> float:
+    return sum(1 for x, y in zip(signature, other) if x == y) / NUM_PERM
+
+
+def make_diff(submission, related) -> str:
+    return "".join(difflib.unified_diff(
+        related.code.splitlines(keepends=True), submission.code.splitlines(keepends=True),
+        fromfile=str(related.filename), tofile=str(submission.filename)))
+
+
+def record_similarity(submission, related, score):
+    """Keep the most similar pair found for the submission's user in the task."""
+    similarity = Similarity.objects.filter(user_id=submission.user_id, task_id=submission.task_id).first()
+    if similarity is not None and similarity.score >= round(score, 3):
+        return similarity
+    if similarity is None:
+        similarity = Similarity(user_id=submission.user_id, task_id=submission.task_id)
+    similarity.submission = submission
+    similarity.related = related
+    similarity.score = round(score, 3)
+    similarity.diff = make_diff(submission, related)
+    similarity.save()
+    return similarity
+
+
+def index_submission(submission):
+    """
+    Fingerprint a submission, add it to its task's index and update the similarities of
+    its user and of the users of its candidate neighbours.
+    """
+    task = submission.task
+    signature = minhash(shingles(submission.code) - shingles(task.template_code))
+    if signature is None:
+        return
+    keys = band_keys(signature)
+
+    with transaction.atomic():
+        fingerprint, _ = Fingerprint.objects.update_or_create(submission=submission,
+                                                              defaults={'task': task, 'signature': signature})
+        fingerprint.bands.all().delete()
+        FingerprintBand.objects.bulk_create([FingerprintBand(fingerprint=fingerprint, task=task, key=key) for key in keys])
+
+    candidates = Fingerprint.objects.filter(task=task, bands__key__in=keys) \
+                                    .exclude(submission__user_id=submission.user_id) \
+                                    .select_related('submission').distinct()
+
+    best = None
+    for candidate in candidates:
+        score = estimate_similarity(signature, candidate.signature)
+        if score < settings.SIMILARITY_MIN_SCORE:
+            continue
+        record_similarity(candidate.submission, submission, score)
+        if best is None or score > best[1]:
+            best = (candidate.submission, score)
+
+    if best is not None:
+        record_similarity(submission, *best)
+
+
+def index_submissions(pks):
+    """Index the given submissions, run by the index_submissions Celery task."""
+    for submission in Submission.objects.filter(pk__in=pks).select_related('task').defer('notes'):
+        index_submission(submission)
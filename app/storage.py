@@ -0,0 +1,66 @@
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+import hashlib
+import os
+import tempfile
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that stores each file under the SHA-256 digest of its content,
+    so identical files share one blob. Only the extension of the requested name is kept.
+    """
+    BLOB_DIR = 'blobs'
+
+    @classmethod
+    def blob_name(cls, digest, ext=''):
+        return '/'.join([cls.BLOB_DIR, digest[:2], digest[2:4], digest + ext])
+
+    @classmethod
+    def digest(cls, name):
+        """Return the content digest encoded in a blob name, or None for files stored elsewhere."""
+        if not name or not name.startswith(cls.BLOB_DIR + '/'):
+            return None
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def get_available_name(self, name, max_length=None):
+        # Blob names are derived from content, equal names mean equal content.
+        return name
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1]
+
+        # Digest computed by the upload handlers, skip the write if the content is already stored
+        digest = getattr(content, 'digest', None)
+        if digest is not None and self.exists(self.blob_name(digest.sha256, ext)):
+            return self.blob_name(digest.sha256, ext)
+
+        directory = self.path(self.BLOB_DIR)
+        os.makedirs(directory, exist_ok=True)
+
+        # Hash while writing to a temporary blob, then move it in place unless it already exists
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    f.write(chunk)
+            blob_name = self.blob_name(hasher.hexdigest(), ext)
+            blob_path = self.path(blob_name)
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return blob_name
+
+
+package_storage = ContentAddressedStorage()
@@ -0,0 +1,22 @@
+from celery import shared_task
+from . import jobs, outbox, regrades, similarity
+
+
+@shared_task(ignore_result=True)
+def reap_expired_jobs():
+    jobs.reap_expired_jobs()
+
+
+@shared_task(ignore_result=True)
+def publish_outbox():
+    outbox.drain()
+
+
+@shared_task(ignore_result=True)
+def advance_regrades():
+    regrades.advance_regrades()
+
+
+@shared_task(ignore_result=True)
+def index_submissions(pks):
+    similarity.index_submissions(pks)
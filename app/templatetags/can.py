@@ -1,6 +1,9 @@
 from django import template
-from ..funcs import can
+from .. import funcs
 
 register = template.Library()
 
-register.simple_tag(can)
\ No newline at end of file
+@register.simple_tag(takes_context=True)
+def can(context, course, user, action, participation=None, submission=None):
+    return funcs.can(course, user, action, participation=participation, submission=submission,
+                     request=context.get('request'))
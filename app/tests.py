@@ -1,3 +1,715 @@
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.forms.models import model_to_dict
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+from .forms import TaskCodeForm, TaskFormConfig
+from .funcs import can, get_base_request, submissions_evaluate
+from .models import Course, OutboxMessage, Participation, Partition, Regrade, Similarity, Submission, Task, TaskVersion
+from .storage import ContentAddressedStorage, package_storage
+from .utils import ZipStreamBuffer, copy_zip_entry, create_download_response, create_zip_file, get_zip_manifest, \
+                   parse_range_header, stream_zip_file, validate_zip_package
+from . import events, jobs, memos, outbox, permissions, queues, regrades, scheduler, similarity
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+import zlib
 
-# Create your tests here.
+
+class ZipCopyTests(SimpleTestCase):
+    """copy_zip_entry relies on zipfile internals, these pin the archives it produces."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.source = os.path.join(self.directory, 'source.zip')
+        self.code = "import numpy as np\n" * 500
+
+        with zipfile.ZipFile(self.source, 'w') as zipf:
+            zipf.writestr('agent.py', self.code, compress_type=zipfile.ZIP_DEFLATED)
+            zipf.writestr('README', 'stored', compress_type=zipfile.ZIP_STORED)
+            zipf.writestr('old.txt', 'to delete')
+        # An unseekable stream makes zipfile write the sizes in a data descriptor
+        stream = ZipStreamBuffer()
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('streamed.py', self.code)
+        self.streamed = os.path.join(self.directory, 'streamed.zip')
+        with open(self.streamed, 'wb') as f:
+            f.write(stream.drain())
+
+    def copy(self, source, path):
+        with zipfile.ZipFile(source) as source_zipf, zipfile.ZipFile(path, 'w') as target_zipf:
+            for item in source_zipf.infolist():
+                copy_zip_entry(source_zipf, target_zipf, item)
+
+    def test_copy_deflated_entry(self):
+        target = os.path.join(self.directory, 'target.zip')
+        self.copy(self.source, target)
+        with zipfile.ZipFile(target) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.getinfo('agent.py').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(zipf.read('agent.py').decode(), self.code)
+            self.assertEqual(zipf.read('README'), b'stored')
+
+    def test_copy_data_descriptor_entry(self):
+        with zipfile.ZipFile(self.streamed) as zipf:
+            self.assertTrue(zipf.getinfo('streamed.py').flag_bits & zipfile._MASK_USE_DATA_DESCRIPTOR)
+        target = os.path.join(self.directory, 'target.zip')
+        self.copy(self.streamed, target)
+        with zipfile.ZipFile(target) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertFalse(zipf.getinfo('streamed.py').flag_bits & zipfile._MASK_USE_DATA_DESCRIPTOR)
+            self.assertEqual(zipf.read('streamed.py').decode(), self.code)
+
+    def test_create_zip_file(self):
+        target = os.path.join(self.directory, 'target.zip')
+        create_zip_file(target, self.source, delete_files=['old.txt'],
+                        add_files=[('data/weights.bin', ContentFile(b'\x00\x01' * 1000))],
+                        texts=[('agent.py', 'print(1)\n')])
+        with zipfile.ZipFile(target) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(sorted(zipf.namelist()), ['README', 'agent.py', 'data/weights.bin'])
+            self.assertEqual(zipf.read('agent.py'), b'print(1)\n')
+            self.assertEqual(zipf.read('data/weights.bin'), b'\x00\x01' * 1000)
+
+
+    def test_stream_zip_file_skips_missing_files(self):
+        missing = os.path.join(self.directory, 'missing.zip')
+        stream = io.BytesIO(b''.join(stream_zip_file([('a/source.zip', self.source), ('b/missing.zip', missing), ('c/none.zip', None)])))
+        with zipfile.ZipFile(stream) as zipf:
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.namelist(), ['a/source.zip', 'b/missing.zip.missing', 'c/none.zip.missing'])
+            with open(self.source, 'rb') as f:
+                self.assertEqual(zipf.read('a/source.zip'), f.read())
+
+    def test_zip_manifest_follows_file_changes(self):
+        path = os.path.join(self.directory, 'package.zip')
+        with zipfile.ZipFile(path, 'w') as zipf:
+            zipf.writestr('agent.py', 'print(1)')
+        self.assertEqual(get_zip_manifest(path, ('agent.py',))['texts'], {'agent.py': 'print(1)'})
+        with mock.patch('app.utils.read_zip_manifest') as read: # Cached
+            get_zip_manifest(path, ('agent.py',))
+            read.assert_not_called()
+
+        stat = os.stat(path)
+        with zipfile.ZipFile(path, 'w') as zipf:
+            zipf.writestr('agent.py', 'print(2)')
+            zipf.writestr('data.txt', 'data')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        manifest = get_zip_manifest(path, ('agent.py',))
+        self.assertEqual(manifest['texts'], {'agent.py': 'print(2)'})
+        self.assertEqual(manifest['names'], ['agent.py', 'data.txt'])
+
+        os.remove(path)
+        self.assertIsNone(get_zip_manifest(path))
+
+@override_settings(DOWNLOAD_ACCEL_REDIRECT_PREFIX=None, DOWNLOAD_SENDFILE=False)
+class DownloadTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'package.zip')
+        self.data = bytes(range(100))
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.file = SimpleNamespace(name='package.zip', path=self.path)
+
+    def download(self, **headers):
+        request = RequestFactory().get('/', headers=headers)
+        response = create_download_response(request, self.file, 'application/zip', etag='abc')
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=10-19', 100), (10, 19))
+        self.assertEqual(parse_range_header('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range_header('bytes=95-200', 100), (95, 99))
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header('bytes=0-1,5-6', 100))
+        with self.assertRaises(ValueError):
+            parse_range_header('bytes=100-', 100)
+
+    def test_single_range(self):
+        response, content = self.download(Range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(content, self.data[10:20])
+
+    def test_suffix_range(self):
+        response, content = self.download(Range='bytes=-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 90-99/100')
+        self.assertEqual(content, self.data[90:])
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.download(Range='bytes=200-300')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_multi_range_is_ignored(self):
+        response, content = self.download(Range='bytes=0-9,20-29')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.data)
+
+    def test_if_none_match(self):
+        response, _ = self.download(**{'If-None-Match': '"abc"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], '"abc"')
+
+class ZipValidationTests(SimpleTestCase):
+    MAIN_FILE = 'aicon_submission/__init__.py'
+
+    def validate(self, files, max_entries=100, max_uncompressed_size=1024 * 1024):
+        stream = io.BytesIO()
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+            for name, data in files.items():
+                zipf.writestr(name, data)
+        return validate_zip_package(stream, self.MAIN_FILE, max_entries=max_entries, max_uncompressed_size=max_uncompressed_size)
+
+    def test_valid_package(self):
+        self.assertIsNone(self.validate({self.MAIN_FILE: 'print(1)', 'aicon_submission/data.txt': 'data'}))
+
+    def test_rejects_path_traversal(self):
+        for name in ['../evil.py', 'aicon_submission/../../evil.py', '/etc/evil.py', 'C:/evil.py']:
+            with self.subTest(name=name):
+                self.assertIn('unsafe path', self.validate({self.MAIN_FILE: 'print(1)', name: 'x'}))
+
+    def test_rejects_zip_bomb(self):
+        # 2MB of zeros compress to a few KB, the declared size is checked without decompressing
+        message = self.validate({self.MAIN_FILE: 'print(1)', 'aicon_submission/zeros.bin': b'\0' * (2 * 1024 * 1024)})
+        self.assertIn('too large when extracted', message)
+
+    def test_rejects_too_many_entries(self):
+        files = {self.MAIN_FILE: 'print(1)', **{f'aicon_submission/{i}.txt': '' for i in range(10)}}
+        self.assertIn('too many files', self.validate(files, max_entries=10))
+
+    def test_rejects_missing_main_file(self):
+        self.assertEqual(self.validate({'aicon_submission/agent.py': 'print(1)'}), f"Package doesn't contain {self.MAIN_FILE}.")
+
+    def test_rejects_invalid_zip(self):
+        self.assertEqual(validate_zip_package(io.BytesIO(b'not a zip'), self.MAIN_FILE, 100, 1024), "File is not a valid zip file.")
+
+class FailingBroker(outbox.MemoryBroker):
+    """Broker that goes down after `fail_after` messages."""
+    def __init__(self, fail_after=0):
+        super().__init__()
+        self.fail_after = fail_after
+
+    def send_task(self, name, args=None, **options):
+        if len(self.messages) >= self.fail_after:
+            raise ConnectionError("Broker down")
+        super().send_task(name, args, **options)
+
+
+def make_package(files) -> ContentFile:
+    stream = ZipStreamBuffer()
+    with zipfile.ZipFile(stream, 'w') as zipf:
+        for name, text in files.items():
+            zipf.writestr(name, text)
+    return ContentFile(stream.drain(), name='package.zip')
+
+
+class JobsTestCase(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+        self.course = Course.objects.create(code='CS4246', academic_year='2026/2027', semester=1)
+        self.task = self.create_task('Task')
+        self.users = [User.objects.create(username=f'student{i}') for i in range(2)]
+
+    def create_task(self, name, **fields):
+        return Task.objects.create(course=self.course, name=name, file=make_package({'agent.py': name}), **fields)
+
+    def submit(self, user=None, count=1, **fields):
+        return [Submission.objects.create(task=self.task, user=user or self.users[0], **fields) for _ in range(count)]
+
+
+class OutboxTests(JobsTestCase):
+    def add(self, count):
+        outbox.add([('aicon_runner.tasks.evaluate', [i], {'queue': 'celery'}) for i in range(count)])
+
+    def test_publish_deletes_sent_messages(self):
+        self.add(3)
+        broker = outbox.MemoryBroker()
+        self.assertEqual(outbox.publish(broker), (3, False))
+        self.assertEqual([args for _, args, _ in broker.messages], [[0], [1], [2]])
+        self.assertEqual(broker.messages[0][2], {'queue': 'celery'})
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_publish_stops_at_failure_and_backs_off(self):
+        self.add(3)
+        before = timezone.now()
+        self.assertEqual(outbox.publish(FailingBroker(fail_after=1)), (1, True))
+
+        failed, pending = OutboxMessage.objects.order_by('pk')
+        self.assertEqual(failed.attempts, 1)
+        self.assertIn('Broker down', failed.last_error)
+        self.assertGreaterEqual(failed.available_at, before + outbox.retry_delay(1))
+        self.assertEqual(pending.attempts, 0)
+
+        # The failed message isn't due yet, the next one is
+        broker = outbox.MemoryBroker()
+        self.assertEqual(outbox.publish(broker), (1, False))
+        self.assertEqual(broker.messages[0][1], [2])
+
+    def test_retry_delay_is_capped(self):
+        self.assertEqual(outbox.retry_delay(2), 2 * outbox.retry_delay(1))
+        self.assertEqual(outbox.retry_delay(100).total_seconds(), 300)
+
+    def test_drain_stops_at_failure(self):
+        self.add(5)
+        self.assertEqual(outbox.drain(FailingBroker(fail_after=2), batch_size=2), 2)
+        self.assertEqual(OutboxMessage.objects.count(), 3)
+        self.assertEqual(outbox.drain(outbox.MemoryBroker(), batch_size=2), 2)
+
+    def test_submissions_evaluate_writes_messages_with_the_transaction(self):
+        submissions = self.submit(count=2)
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                submissions_evaluate(get_base_request(), Submission.objects.filter(pk__in=[s.pk for s in submissions]))
+                raise RuntimeError
+        self.assertFalse(OutboxMessage.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                submissions_evaluate(get_base_request(), Submission.objects.filter(pk__in=[s.pk for s in submissions]))
+        messages = list(OutboxMessage.objects.order_by('pk'))
+        self.assertEqual(len(messages), 2)
+        self.assertEqual({message.args[1]['id'] for message in messages}, {s.pk for s in submissions})
+        self.assertEqual(messages[0].name, 'aicon_runner.tasks.evaluate')
+
+    def test_submissions_evaluate_versions_legacy_task_once(self):
+        submissions = self.submit(count=5)
+        TaskVersion.objects.all().delete() # Task saved before versioning
+        self.assertIsNone(Task.objects.get(pk=self.task.pk).version_id)
+
+        submissions_evaluate(get_base_request(), Submission.objects.filter(pk__in=[s.pk for s in submissions]).select_related('task'))
+        version = TaskVersion.objects.get()
+        self.assertEqual(Task.objects.get(pk=self.task.pk).version_id, version.pk)
+        self.assertEqual(set(Submission.objects.values_list('task_version_id', flat=True)), {version.pk})
+
+
+class PackageManifestTests(JobsTestCase):
+    def test_manifest_leaves_out_sources(self):
+        submission, = self.submit(file=make_package({Submission.MAIN_FILE: 'print(1)', 'aicon_submission/data.txt': 'data'}))
+        submission = Submission.objects.get(pk=submission.pk)
+        self.assertEqual(set(submission.file_manifest), {'size', 'names', 'sizes', 'hashes'})
+        self.assertEqual(submission.file_manifest['sizes'][Submission.MAIN_FILE], 8)
+        self.assertEqual(submission.file_manifest['hashes'][Submission.MAIN_FILE], f'{zlib.crc32(b"print(1)"):08x}')
+        self.assertEqual(submission.code, 'print(1)')
+
+def legacy_can(course, user, action, participation=None, submission=None):
+    """funcs.can before the PermissionResolver, one query per check."""
+    if submission and submission.user == user:
+        return True
+    if not participation:
+        participation = Participation.objects.filter(user=user, course=course).first()
+    return participation and participation.role in settings.ROLES[action]
+
+
+class PermissionTests(JobsTestCase):
+    ACTIONS = ['task.view', 'task.edit', 'task.download', 'submission.view', 'submission.download']
+
+    def setUp(self):
+        super().setUp()
+        self.student, other = self.users
+        self.ta = User.objects.create(username='ta')
+        self.admin = User.objects.create(username='admin')
+        for user, role in [(self.student, 'STU'), (other, 'STU'), (self.ta, 'TA'), (self.admin, 'ADM')]:
+            Participation.objects.create(user=user, course=self.course, role=role)
+        self.outsider = User.objects.create(username='outsider')
+        self.submissions = self.submit(self.student) + self.submit(other)
+
+    def test_resolver_matches_legacy_checks(self):
+        users = [self.student, self.ta, self.admin, self.outsider]
+        resolver = permissions.PermissionResolver() # Shared by all checks, as within a request
+        for user in users:
+            for action in self.ACTIONS:
+                for submission in [None, *self.submissions]:
+                    with self.subTest(user=user.username, action=action, submission=submission and submission.pk):
+                        expected = bool(legacy_can(self.course, user, action, submission=submission))
+                        self.assertEqual(resolver.can(self.course, user, action, submission=submission), expected)
+                        self.assertEqual(bool(can(self.course, user, action, submission=submission)), expected)
+
+    def test_resolver_is_per_request(self):
+        first, second = RequestFactory().get('/'), RequestFactory().get('/')
+        self.assertIs(permissions.get_resolver(first), permissions.get_resolver(first))
+        self.assertIsNot(permissions.get_resolver(first), permissions.get_resolver(second))
+
+        self.assertFalse(can(self.course, self.student, 'task.edit', request=first))
+        Participation.objects.filter(user=self.student).update(role='TA')
+        self.assertFalse(can(self.course, self.student, 'task.edit', request=first))
+        self.assertTrue(can(self.course, self.student, 'task.edit', request=second))
+
+class StorageTests(JobsTestCase):
+    def test_identical_uploads_share_one_blob(self):
+        def blobs():
+            return {name for _, _, names in os.walk(package_storage.path(ContentAddressedStorage.BLOB_DIR)) for name in names}
+
+        data = make_package({Submission.MAIN_FILE: 'print(1)'}).read()
+        before = blobs() # Task packages
+        first, second = [Submission.objects.create(task=self.task, user=user, file=ContentFile(data, name='package.zip'))
+                         for user in self.users]
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(first.file_hash, hashlib.sha256(data).hexdigest())
+        self.assertEqual(first.file_hash, second.file_hash)
+        self.assertEqual(blobs() - before, {os.path.basename(first.file.name)})
+
+        other = package_storage.save('package.zip', ContentFile(data + b'\0'))
+        self.assertNotEqual(other, first.file.name)
+
+class SimilarityTests(JobsTestCase):
+    CODE = "\n".join(f"def step_{i}(state, action):\n    return state * {i} + action - {i * 7}" for i in range(40))
+    NEAR_DUPLICATE = CODE.replace("step_3(", "move_3(").replace("* 17 +", "* 71 +")
+    UNRELATED = "\n".join(f"class Agent{i}:\n    def act(self, obs):\n        return max(obs, key=len) or '{i}'" for i in range(40))
+
+    def signature(self, code):
+        return similarity.minhash(similarity.shingles(code))
+
+    def test_near_duplicates_share_a_band(self):
+        original, near, unrelated = (set(similarity.band_keys(self.signature(code)))
+                                     for code in (self.CODE, self.NEAR_DUPLICATE, self.UNRELATED))
+        self.assertTrue(original & near)
+        self.assertFalse(original & unrelated)
+        self.assertGreater(similarity.estimate_similarity(self.signature(self.CODE), self.signature(self.NEAR_DUPLICATE)), 0.8)
+
+    def test_index_records_near_duplicates(self):
+        first, second, third = [Submission.objects.create(task=self.task, user=user, file=make_package({Submission.MAIN_FILE: code}))
+                                for user, code in zip(self.users + [User.objects.create(username='student2')],
+                                                      (self.CODE, self.NEAR_DUPLICATE, self.UNRELATED))]
+        similarity.index_submissions([first.pk, second.pk, third.pk])
+        pairs = {(s.submission_id, s.related_id) for s in Similarity.objects.all()}
+        self.assertEqual(pairs, {(first.pk, second.pk), (second.pk, first.pk)})
+
+class TaskCodeFormTests(JobsTestCase):
+    def save(self, task, **data):
+        data = {**model_to_dict(task, fields=['name', 'description', *TaskFormConfig.FIELDS]),
+                'code': task.code, 'setup': task.setup or '', 'template_code': task.template_code, **data}
+        data = {key: value for key, value in data.items() if value is not None}
+        form = TaskCodeForm(data, instance=task)
+        self.assertTrue(form.is_valid(), form.errors)
+        return form.save()
+
+    def test_unchanged_save_keeps_version(self):
+        task = self.save(self.task, code='print(1)')
+        version_id = task.version_id
+        for later in (60, 120): # Saved at other times
+            with mock.patch('app.utils.time.time', return_value=time.time() + later):
+                task = self.save(Task.objects.get(pk=task.pk))
+        self.assertEqual(Task.objects.get(pk=task.pk).version_id, version_id)
+
+        task = self.save(Task.objects.get(pk=task.pk), code='print(2)')
+        self.assertNotEqual(Task.objects.get(pk=task.pk).version_id, version_id)
+
+class TaskApiTests(JobsTestCase):
+    def test_list_is_paginated(self):
+        for i in range(11):
+            self.create_task(f'Task {i}')
+        client = APIClient(SERVER_NAME='127.0.0.1')
+        client.force_authenticate(User.objects.create(username='admin', is_staff=True))
+
+        data = client.get('/api/v1/tasks/').json()
+        self.assertEqual(data['count'], 12)
+        self.assertEqual([task['id'] for task in data['results']], list(Task.objects.order_by('pk').values_list('pk', flat=True)[:10]))
+        self.assertEqual(len(client.get(data['next']).json()['results']), 2)
+
+class SchedulerTests(JobsTestCase):
+    def test_fair_order_interleaves_users(self):
+        first = self.submit(self.users[0], count=3)
+        second = self.submit(self.users[1], count=2)
+        expected = [first[0], second[0], first[1], second[1], first[2]]
+
+        ordered = scheduler.fair_order(Submission.objects.filter(status=Submission.STATUS_QUEUED))
+        self.assertEqual([s.pk for s in ordered], [s.pk for s in expected])
+        planned = scheduler.plan(Submission.objects.filter(pk__in=[s.pk for s in first + second]).select_related('task'))
+        self.assertEqual([s.pk for s, _, _ in planned], [s.pk for s in expected])
+        self.assertEqual([priority for _, _, priority in planned], sorted(priority for _, _, priority in planned)[::-1])
+
+    def test_routing_is_off_by_default(self):
+        self.task.partition = Partition.objects.create(name='gpu-cluster')
+        self.task.gpus = '1'
+        self.task.save()
+        submissions = self.submit(count=2)
+
+        self.assertFalse(settings.SCHEDULER_ROUTE_QUEUES)
+        submissions_evaluate(get_base_request(), Submission.objects.filter(pk__in=[s.pk for s in submissions]).select_related('task'))
+        self.assertEqual({message.options['queue'] for message in OutboxMessage.objects.all()}, {settings.SCHEDULER_DEFAULT_QUEUE})
+        with override_settings(SCHEDULER_ROUTE_QUEUES=True):
+            self.assertEqual(scheduler.route(self.task), f'{settings.SCHEDULER_DEFAULT_QUEUE}.gpu-cluster.gpu')
+
+class LeasingTests(JobsTestCase):
+    def test_claim_leases_queued_jobs_once(self):
+        submissions = self.submit(count=3)
+        claimed = jobs.claim_jobs(2)
+        self.assertEqual([s.pk for s in claimed], [s.pk for s in submissions[:2]])
+        for submission in claimed:
+            self.assertEqual(submission.status, Submission.STATUS_RUNNING)
+            self.assertEqual(submission.attempts, 1)
+            self.assertIsNotNone(submission.lease_id)
+            self.assertGreater(submission.lease_expires_at, timezone.now())
+
+        self.assertEqual([s.pk for s in jobs.claim_jobs(5)], [submissions[2].pk])
+        self.assertEqual(jobs.claim_jobs(5), [])
+
+    def test_claim_is_fair_across_users(self):
+        first = self.submit(self.users[0], count=3)
+        second = self.submit(self.users[1])
+        claimed = jobs.claim_jobs(2)
+        self.assertEqual([s.pk for s in claimed], [first[0].pk, second[0].pk])
+
+    @override_settings(JOB_CLAIM_MAX_LIMIT=2)
+    def test_claim_limit_is_capped(self):
+        self.submit(count=3)
+        self.assertEqual(len(jobs.claim_jobs(10)), 2)
+        self.assertEqual(jobs.claim_jobs(0), [])
+
+    def test_claim_filters_gpus(self):
+        gpu_task = self.create_task('GPU Task', gpus='a100:1')
+        cpu = self.submit()[0]
+        gpu = Submission.objects.create(task=gpu_task, user=self.users[1])
+        self.assertEqual([s.pk for s in jobs.claim_jobs(5, gpus=False)], [cpu.pk])
+        self.assertEqual([s.pk for s in jobs.claim_jobs(5, gpus=['a100:1'])], [gpu.pk])
+
+    def test_heartbeat_extends_held_leases(self):
+        self.submit()
+        submission = jobs.claim_jobs(1)[0]
+        Submission.objects.filter(pk=submission.pk).update(lease_expires_at=timezone.now())
+        self.assertEqual(jobs.heartbeat([submission.lease_id, 'reaped']), [submission.lease_id])
+        self.assertGreater(Submission.objects.get(pk=submission.pk).lease_expires_at, timezone.now() + timedelta(seconds=60))
+
+    def test_reap_requeues_expired_jobs(self):
+        self.submit(count=2)
+        expired, held = jobs.claim_jobs(2)
+        Submission.objects.filter(pk=expired.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(jobs.reap_expired_jobs(), (1, 0))
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, Submission.STATUS_QUEUED)
+        self.assertIsNone(expired.lease_id)
+        self.assertEqual(Submission.objects.get(pk=held.pk).status, Submission.STATUS_RUNNING)
+        self.assertEqual([message.args[1]['id'] for message in OutboxMessage.objects.all()], [expired.pk])
+
+        # Claimed again, the attempts go on
+        self.assertEqual(jobs.claim_jobs(1)[0].attempts, 2)
+
+    @override_settings(JOB_MAX_ATTEMPTS=1)
+    def test_reap_errors_out_after_max_attempts(self):
+        self.submit()
+        submission = jobs.claim_jobs(1)[0]
+        Submission.objects.filter(pk=submission.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(jobs.reap_expired_jobs(), (0, 1))
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.STATUS_ERROR)
+        self.assertEqual(json.loads(submission.notes)['error']['type'], 'RunnerLost')
+        self.assertEqual(submission.info, 'Runner Lost')
+        self.assertFalse(OutboxMessage.objects.filter(name='aicon_runner.tasks.evaluate').exists())
+
+    def test_end_rejects_stale_leases(self):
+        self.submit(count=2)
+        first, second = jobs.claim_jobs(2)
+        ended, rejected = jobs.end_jobs([
+            {'id': first.pk, 'lease_id': first.lease_id, 'status': Submission.STATUS_DONE, 'point': 1},
+            {'id': second.pk, 'lease_id': 'reclaimed', 'status': Submission.STATUS_DONE, 'point': 1},
+        ])
+        self.assertEqual((ended, rejected), ([first.pk], [second.pk]))
+        self.assertEqual(Submission.objects.get(pk=first.pk).status, Submission.STATUS_DONE)
+        self.assertEqual(Submission.objects.get(pk=second.pk).status, Submission.STATUS_RUNNING)
+
+
+@override_settings(REGRADE_CHUNK_SIZE=2, REGRADE_MAX_IN_FLIGHT=2)
+class RegradeTests(JobsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.request = RequestFactory().get('/')
+        self.request.user = User.objects.create(username='lecturer')
+        self.submissions = self.submit(count=5, status=Submission.STATUS_DONE)
+
+    def statuses(self):
+        return ''.join(Submission.objects.order_by('pk').values_list('status', flat=True))
+
+    def finish_running(self):
+        running = jobs.claim_jobs(10)
+        jobs.end_jobs([{'id': s.pk, 'lease_id': s.lease_id, 'status': Submission.STATUS_DONE, 'point': 1} for s in running])
+
+    def test_small_rerun_is_queued_at_once(self):
+        self.assertIsNone(regrades.rerun(self.request, Submission.objects.filter(pk__in=[s.pk for s in self.submissions[:2]])))
+        self.assertEqual(self.statuses(), 'QQDDD')
+        self.assertFalse(Regrade.objects.exists())
+
+    def test_regrade_advances_as_jobs_finish(self):
+        regrade = regrades.rerun(self.request, self.task.submissions.all(), task=self.task)
+        self.assertEqual((regrade.total, regrade.dispatched), (5, 2))
+        self.assertEqual(self.statuses(), 'QQDDD')
+
+        # Nothing more while the chunk is in flight
+        regrades.advance(regrade)
+        self.assertEqual(self.statuses(), 'QQDDD')
+
+        self.finish_running()
+        self.assertEqual(self.statuses(), 'DDQQD')
+        self.finish_running()
+        self.assertEqual(self.statuses(), 'DDDDQ')
+        self.finish_running()
+        regrade.refresh_from_db()
+        self.assertEqual(regrade.dispatched, 5)
+        self.assertIsNotNone(regrade.finished_at)
+
+    @override_settings(JOB_MAX_ATTEMPTS=1)
+    def test_reaped_job_advances_regrade(self):
+        regrade = regrades.rerun(self.request, self.task.submissions.all(), task=self.task)
+        lost, held = jobs.claim_jobs(2)
+        jobs.end_jobs([{'id': held.pk, 'lease_id': held.lease_id, 'status': Submission.STATUS_DONE}])
+        self.assertEqual(self.statuses(), 'RDQDD')
+
+        Submission.objects.filter(pk=lost.pk).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(jobs.reap_expired_jobs(), (0, 1))
+        self.assertEqual(self.statuses(), 'EDQQD')
+        regrade.refresh_from_db()
+        self.assertEqual(regrade.dispatched, 4)
+
+class MemoTests(JobsTestCase):
+    def finish(self, submission, point):
+        Submission.objects.filter(pk=submission.pk).update(status=Submission.STATUS_DONE, point=point, notes='{}')
+        memos.record([submission.pk])
+
+    def test_memo_completes_identical_submission(self):
+        first, second = self.submit(count=2, file=make_package({'agent.py': 'print(1)'}))
+        self.finish(first, 5)
+        hits = memos.apply(Submission.objects.filter(pk=second.pk).select_related('task'))
+        self.assertEqual([(s.pk, s.status, s.point) for s in hits], [(second.pk, Submission.STATUS_DONE, 5)])
+
+    def test_memo_is_invalidated_by_task_settings(self):
+        first, second = self.submit(count=2, file=make_package({'agent.py': 'print(1)'}))
+        self.finish(first, 5)
+        self.task.run_time_limit += 60
+        self.task.save()
+        self.assertEqual(memos.apply(Submission.objects.filter(pk=second.pk).select_related('task')), [])
+
+    def test_memo_is_keyed_on_the_evaluated_version(self):
+        package = {'agent.py': 'print(1)'}
+        first, = self.submit(file=make_package(package))
+        submissions_evaluate(get_base_request(), Submission.objects.filter(pk=first.pk).select_related('task'))
+        self.task.run_time_limit += 60 # Changed while the job runs
+        self.task.save()
+        self.finish(first, 5)
+
+        second, = self.submit(file=make_package(package))
+        self.assertEqual(memos.apply(Submission.objects.filter(pk=second.pk).select_related('task')), [])
+        self.task.run_time_limit -= 60
+        self.task.save()
+        self.assertEqual(len(memos.apply(Submission.objects.filter(pk=second.pk).select_related('task'))), 1)
+
+
+class QueueTests(JobsTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.other_task = self.create_task('Other', partition=Partition.objects.create(name='gpu'))
+
+    def positions(self, submissions):
+        return [Submission.objects.get(pk=s.pk).queue_position for s in submissions]
+
+    def test_positions_after_rebuild(self):
+        first, second = self.submit(count=2)
+        other = Submission.objects.create(task=self.other_task, user=self.users[1])
+        third, = self.submit()
+        submissions = [first, second, other, third]
+        self.assertEqual(self.positions(submissions), [(1, 1), (2, 2), (3, 1), (4, 3)])
+
+        # Incremental updates, then a rebuild from the database gives the same positions
+        Submission.objects.filter(pk=first.pk).update(status=Submission.STATUS_RUNNING)
+        queues.dequeued([first.pk])
+        incremental = self.positions(submissions[1:])
+        self.assertEqual(incremental, [(1, 1), (2, 1), (3, 2)])
+        queues.invalidate()
+        self.assertEqual(self.positions(submissions[1:]), incremental)
+        self.assertIsNone(self.positions([first])[0])
+
+    def test_unindexed_submission_triggers_rebuild(self):
+        first, = self.submit()
+        self.assertEqual(self.positions([first]), [(1, 1)])
+        second, = self.submit() # Queued without updating the index
+        self.assertEqual(self.positions([second]), [(2, 2)])
+
+@override_settings(EVENTS_CONDITIONAL_PARTIALS=True)
+class PartialTests(JobsTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.ahead, self.submission = self.submit(count=2)
+        queues.get_ranks()
+        self.client.force_login(self.users[0])
+        self.url = reverse('partial_submission', args=(self.submission.pk,))
+
+    def test_unchanged_version_is_not_modified(self):
+        cache.set(events.submission_key(self.submission.pk), 1)
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, headers={'If-None-Match': etag}).status_code, 304)
+
+    def test_queue_move_is_rendered(self):
+        cache.set(events.submission_key(self.submission.pk), 1)
+        etag = self.client.get(self.url)['ETag']
+        Submission.objects.filter(pk=self.ahead.pk).update(status=Submission.STATUS_RUNNING)
+        queues.dequeued([self.ahead.pk])
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_missing_version_is_rendered(self):
+        # An ETag of a version that defaulted to 0 before the key was bumped and evicted
+        etag = f'"0.{queues.get_version()}-{self.users[0].pk}"'
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+
+@override_settings(EVENTS_POLL_INTERVAL=0.01, EVENTS_STREAM_TIMEOUT=0.3)
+class EventTests(JobsTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.ahead, self.submission = self.submit(count=2)
+        cache.set(events.submission_key(self.submission.pk), 1)
+        queues.get_ranks()
+
+    async def follow(self, waiting):
+        async def move():
+            await asyncio.sleep(0.05)
+            await sync_to_async(queues.dequeued)([self.ahead.pk])
+
+        moving = asyncio.create_task(move())
+        chunks = [chunk async for chunk in events.stream(events.submission_key(self.submission.pk), '1', waiting)]
+        await moving
+        return chunks
+
+    async def test_queue_move_is_sent_to_waiting_submissions(self):
+        chunks = await self.follow(Submission.objects.filter(pk=self.submission.pk, status=Submission.STATUS_QUEUED))
+        self.assertEqual([chunk for chunk in chunks if 'event: changed' in chunk], ["id: 1\nevent: changed\ndata: 1\n\n"])
+
+    async def test_queue_move_is_not_sent_to_final_submissions(self):
+        await Submission.objects.filter(pk=self.submission.pk).aupdate(status=Submission.STATUS_DONE)
+        chunks = await self.follow(Submission.objects.filter(pk=self.submission.pk, status=Submission.STATUS_QUEUED))
+        self.assertFalse([chunk for chunk in chunks if 'event: changed' in chunk])
@@ -0,0 +1,74 @@
+from django.core.files.uploadhandler import FileUploadHandler, MemoryFileUploadHandler, TemporaryFileUploadHandler, SkipFile
+from collections import namedtuple
+import hashlib
+import zipfile
+
+
+UploadDigest = namedtuple('UploadDigest', ['md5', 'sha256', 'size', 'has_central_directory'])
+
+
+class DigestUploadMixin:
+    """
+    Computes the MD5 and SHA-256 digests and the size of an uploaded file while its chunks
+    arrive, and checks that it ends with a zip end of central directory record.
+    The result is attached to the uploaded file as `file.digest`.
+    """
+    # End of central directory record plus the longest possible comment
+    TAIL_SIZE = zipfile.sizeEndCentDir + 0xFFFF
+
+    def new_file(self, *args, **kwargs):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.tail = b""
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining = super().receive_data_chunk(raw_data, start)
+        if remaining is None: # Chunk consumed by this handler
+            self.md5.update(raw_data)
+            self.sha256.update(raw_data)
+            self.tail = (self.tail + raw_data)[-self.TAIL_SIZE:]
+        return remaining
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.digest = UploadDigest(
+                md5=self.md5.hexdigest(),
+                sha256=self.sha256.hexdigest(),
+                size=file_size,
+                has_central_directory=self.tail.rfind(zipfile.stringEndArchive) != -1,
+            )
+        return file
+
+
+class DigestMemoryFileUploadHandler(DigestUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class DigestTemporaryFileUploadHandler(DigestUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+class MaxSizeUploadHandler(FileUploadHandler):
+    """
+    Skips an uploaded file as soon as it grows over `max_size` bytes instead of receiving
+    it whole. The reason is recorded in `request.upload_errors` by field name.
+    Must be inserted before the other handlers, see views.submission_new_package.
+    """
+    def __init__(self, request, max_size):
+        super().__init__(request)
+        self.max_size = max_size
+
+    def receive_data_chunk(self, raw_data, start):
+        size = start + len(raw_data)
+        if size > self.max_size:
+            if not hasattr(self.request, 'upload_errors'):
+                self.request.upload_errors = {}
+            self.request.upload_errors[self.field_name] = \
+                f"File size is too large (> {round(self.max_size/1024)}KB)."
+            raise SkipFile()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
@@ -1,9 +1,26 @@
+import copy
 import math
 import os
 import re
+import struct
+import threading
+import time
 import zipfile
-from django.http import HttpResponse
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from cachetools import LRUCache
+from contextlib import contextmanager
+from django.conf import settings
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.core.files import File
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, quote_etag
+from urllib.parse import quote
+
+# Parsed zip manifests, keyed by (path, mtime, size, text files) so a package
+# that is rewritten in place is parsed again on next access.
+ZIP_MANIFEST_CACHE_SIZE = 256
+_zip_manifest_cache = LRUCache(maxsize=ZIP_MANIFEST_CACHE_SIZE)
+_zip_manifest_lock = threading.Lock()
+_MISSING = object()
 
 def percentile(N, percent, key=lambda x:x):
     """
@@ -30,12 +47,86 @@ def quantiles(N, percents):
     N = sorted(N)
     return [percentile(N, p) for p in percents]
 
-def create_download_response(file, content_type):
-    filename = os.path.basename(file.name)
-    response = HttpResponse(file, content_type=content_type)
-    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+def parse_range_header(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Parse a single `bytes=start-end` range, returns the inclusive (start, end) or None if absent,
+    malformed or a multi-range request (those are answered with the whole file).
+    Raises ValueError if the range is not satisfiable.
+    """
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header or '')
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def iter_file_range(f, start, length, chunk_size=65536):
+    try:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def create_download_response(request, file, content_type, filename=None, etag=None, cache_control='private, no-cache'):
+    """
+    Download response for a stored file with ETag / Last-Modified validation and single
+    byte range support. `etag` should be a content hash, otherwise a weak ETag is derived
+    from the file's modification time and size. The file is handed off to the front-end
+    server when DOWNLOAD_ACCEL_REDIRECT_PREFIX or DOWNLOAD_SENDFILE is set.
+    Immutable files may pass a `cache_control` allowing clients to keep them.
+    """
+    filename = filename or os.path.basename(file.name)
+    path = file.path
+    stat = os.stat(path)
+    etag = quote_etag(etag) if etag else 'W/"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        byte_range = None
+        if request.headers.get('If-Range', etag) == etag:
+            try:
+                byte_range = parse_range_header(request.headers.get('Range'), stat.st_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % stat.st_size
+                return response
+
+        if settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX:
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX + \
+                quote(os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/'))
+        elif settings.DOWNLOAD_SENDFILE:
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = path
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(iter_file_range(open(path, 'rb'), start, end - start + 1),
+                                             status=206, content_type=content_type)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+            response['Content-Length'] = end - start + 1
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+        response['Accept-Ranges'] = 'bytes'
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = cache_control
     return response
 
+
 def make_space(text):
     return re.sub(r'((?<=[a-z])[A-Z]|(?<!\A)[A-Z](?=[a-z]))', r' \1', text)
 
@@ -43,8 +134,47 @@ def int_or_flot(x):
     return int(float(x)) if int(float(x)) == float(x) else float(x)
 
 
+def copy_zip_entry(source_zipf: zipfile.ZipFile, target_zipf: zipfile.ZipFile, item: zipfile.ZipInfo,
+                   chunk_size: int = 1024 * 1024):
+    """
+    Copy an entry's compressed bytes from `source_zipf` to `target_zipf` without decompressing
+    and recompressing it. Relies on zipfile internals, the same bookkeeping `ZipFile.open(mode='w')` does.
+    """
+    source_zipf.fp.seek(item.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source_zipf.fp.read(zipfile.sizeFileHeader))
+    source_zipf.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    zinfo = copy.copy(item)
+    zinfo.flag_bits &= ~zipfile._MASK_USE_DATA_DESCRIPTOR  # sizes are known, write them in the local header
+    zinfo.extra = zipfile._strip_extra(item.extra, (1,))  # zip64 extra is regenerated if needed
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+
+    with target_zipf._lock:
+        target_zipf._didModify = True
+        zinfo.header_offset = target_zipf.fp.tell()
+        target_zipf.fp.write(zinfo.FileHeader(zip64))
+        remaining = item.compress_size
+        while remaining > 0:
+            buffer = source_zipf.fp.read(min(chunk_size, remaining))
+            if not buffer:
+                raise zipfile.BadZipFile(f"Truncated entry: {item.filename}")
+            target_zipf.fp.write(buffer)
+            remaining -= len(buffer)
+        target_zipf.start_dir = target_zipf.fp.tell()
+        target_zipf.filelist.append(zinfo)
+        target_zipf.NameToInfo[zinfo.filename] = zinfo
+
+
 def create_zip_file(path: str, source_zip_file: str, delete_files: list[str],
-                    add_files: list[tuple[str,InMemoryUploadedFile]], texts: list[tuple[str,str]]):
+                    add_files: list[tuple[str,File]], texts: list[tuple[str,str]],
+                    date_time: tuple[int, ...] | None = None):
+    """
+    Create a zip file at `path` from `source_zip_file`. Entries that are kept are copied
+    as-is (still compressed), uploaded files are streamed in chunks.
+    Added entries are timestamped with `date_time` (default: now), a fixed value makes
+    identical inputs produce identical zip files.
+    """
+    date_time = date_time or time.localtime(time.time())[:6]
     _delete_files = set(delete_files + [file_path for file_path, file in add_files] + [file_path for file_path, text in texts])
     with zipfile.ZipFile(source_zip_file, "r") as source_zipf:
         with zipfile.ZipFile(path, "w") as target_zipf:
@@ -52,16 +182,72 @@ def create_zip_file(path: str, source_zip_file: str, delete_files: list[str],
             for item in source_zipf.infolist():
                 if item.filename in _delete_files:
                     continue
-                buffer = source_zipf.read(item.filename)
-                target_zipf.writestr(item, buffer)
+                copy_zip_entry(source_zipf, target_zipf, item)
 
             # Add uploaded files
-            for file_path, file_content in add_files:
-                target_zipf.writestr(file_path, file_content)
+            for file_path, file in add_files:
+                zinfo = zipfile.ZipInfo(file_path, date_time=date_time)
+                zinfo.compress_type = target_zipf.compression
+                zinfo.external_attr = 0o600 << 16
+                zinfo.file_size = file.size
+                with target_zipf.open(zinfo, "w") as target_f:
+                    for chunk in file.chunks():
+                        target_f.write(chunk)
 
             # Add texts
             for file_path, text in texts:
-                target_zipf.writestr(file_path, text)
+                zinfo = zipfile.ZipInfo(file_path, date_time=date_time)
+                zinfo.compress_type = target_zipf.compression
+                zinfo.external_attr = 0o600 << 16
+                target_zipf.writestr(zinfo, text)
+
+
+@contextmanager
+def open_zip_members(zip_file_path: str, names: list[str] | None = None):
+    """
+    Open a zip file once and give a lazy iterator of (name, file) pairs over its members
+    (or only `names`). Each file is a streaming read handle, valid until the next member
+    is requested; nothing is read until the consumer reads it.
+    """
+    with zipfile.ZipFile(zip_file_path, "r") as zipf:
+        def members():
+            for item in zipf.infolist():
+                if names is not None and item.filename not in names:
+                    continue
+                with zipf.open(item, "r") as f:
+                    yield item.filename, f
+        yield members()
+
+
+def validate_zip_package(file, main_file: str, max_entries: int, max_uncompressed_size: int) -> str | None:
+    """
+    Check an uploaded zip package using its central directory only (no entry is decompressed).
+    Returns the reason the package is rejected, or None if it is acceptable.
+    """
+    digest = getattr(file, 'digest', None)
+    if digest is not None and not digest.has_central_directory:
+        return "File is not a valid zip file."
+    try:
+        file.seek(0)
+        with zipfile.ZipFile(file, "r") as zipf:
+            infos = zipf.infolist()
+    except (zipfile.BadZipFile, OSError, ValueError):
+        return "File is not a valid zip file."
+    finally:
+        file.seek(0)
+
+    if len(infos) > max_entries:
+        return f"Package has too many files ({len(infos)} > {max_entries})."
+    uncompressed_size = sum(info.file_size for info in infos)
+    if uncompressed_size > max_uncompressed_size:
+        return f"Package is too large when extracted ({round(uncompressed_size/1024)}KB > {round(max_uncompressed_size/1024)}KB)."
+    for info in infos:
+        parts = info.filename.replace("\\", "/").split("/")
+        if info.filename.startswith(("/", "\\")) or ".." in parts or ":" in parts[0]:
+            return f"Package contains an unsafe path: {info.filename}."
+    if main_file not in {info.filename for info in infos}:
+        return f"Package doesn't contain {main_file}."
+    return None
 
 
 def get_code(zip_file_path: str, path: str) -> str | None:
@@ -71,3 +257,95 @@ def get_code(zip_file_path: str, path: str) -> str | None:
                 return f.read().decode("utf-8")
     except (zipfile.BadZipFile, KeyError):
         return None
+
+
+def read_zip_manifest(zip_file_path: str, text_files: tuple[str, ...] = ()) -> dict | None:
+    """
+    Read the archive size, entry names, uncompressed entry sizes and CRC-32 hashes and the
+    decoded source of `text_files` from a zip file. Returns None if the file is not a valid zip file.
+    """
+    try:
+        with zipfile.ZipFile(zip_file_path, "r") as zipf:
+            infos = zipf.infolist()
+            texts = {}
+            for path in text_files:
+                try:
+                    texts[path] = zipf.read(path).decode("utf-8", errors="replace")
+                except KeyError:
+                    pass
+    except (OSError, zipfile.BadZipFile):
+        return None
+    return {
+        'size': os.path.getsize(zip_file_path),
+        'names': [info.filename for info in infos],
+        'sizes': {info.filename: info.file_size for info in infos},
+        'hashes': {info.filename: f'{info.CRC:08x}' for info in infos},
+        'texts': texts,
+    }
+
+
+def get_zip_manifest(zip_file_path: str, text_files: tuple[str, ...] = ()) -> dict | None:
+    """
+    Cached version of `read_zip_manifest`, each zip file is parsed at most once until it changes.
+    """
+    try:
+        stat = os.stat(zip_file_path)
+    except OSError:
+        return None
+    key = (zip_file_path, stat.st_mtime_ns, stat.st_size, tuple(text_files))
+    with _zip_manifest_lock:
+        manifest = _zip_manifest_cache.get(key, _MISSING)
+    if manifest is _MISSING:
+        manifest = read_zip_manifest(zip_file_path, text_files)
+        with _zip_manifest_lock:
+            _zip_manifest_cache[key] = manifest
+    return manifest
+
+
+class ZipStreamBuffer:
+    """
+    Write-only file object for zipfile that keeps written bytes until they are drained,
+    zipfile falls back to data descriptors since it can't seek.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip_file(entries, chunk_size: int = 65536):
+    """
+    Generate a zip file of `entries` ((arcname, path) pairs) chunk by chunk, without temporary
+    files and in constant memory. Entries are stored as-is, packages are already compressed.
+    A file that is missing (or a None path) gets a `<arcname>.missing` placeholder entry, since
+    the response has already started and an error would leave the client a truncated zip.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zipf:
+        for arcname, path in entries:
+            try:
+                source_f = open(path, "rb") if path else None
+            except OSError:
+                source_f = None
+            if source_f is None:
+                zipf.writestr(f"{arcname}.missing", "This file is missing from the server.\n")
+                yield buffer.drain()
+                continue
+            with source_f:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                with zipf.open(zinfo, "w") as target_f:
+                    while chunk := source_f.read(chunk_size):
+                        target_f.write(chunk)
+                        yield buffer.drain()
+            yield buffer.drain()
+    yield buffer.drain()
@@ -1,19 +1,25 @@
 from tempfile import template
-from django.shortcuts import render, get_object_or_404, redirect, reverse
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect, reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.db.models.aggregates import Max
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.contrib.auth import login, authenticate
 from django.core.paginator import Paginator
+from django.db import transaction
 from django.db.models import Count
+from django.conf import settings
+from django.utils.cache import parse_etags, patch_cache_control
 from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from asgiref.sync import sync_to_async
 from aicon.settings import SUBMISSION_BASE_MAIN_FILE, SUBMISSION_BASE_ZIPFILE, TASK_BASE_ZIPFILE, TASK_BASE_MAIN_FILE
 
-from .models import Course, Invitation, Task, Submission, Participation
+from .models import Course, Invitation, Task, Submission, Participation, make_safe_filename
 from .forms import TaskForm, TaskCodeForm, SubmissionForm, SubmissionCodeForm, CourseForm, RegisterForm, CourseJoinForm
-from .funcs import can, submission_evaluate, submission_is_allowed, course_participations, course_participation
-from . import utils
+from .uploadhandlers import MaxSizeUploadHandler
+from .funcs import can, submission_evaluate, submission_is_allowed, course_participations, course_participation, export_submissions
+from . import events, queues, regrades, utils
 
 import re
 import os
@@ -50,7 +56,7 @@ def course_join(request, course_pk):
             messages.error(request, 'You have already joined the course.')
             return redirect(redirect_url)
 
-        if not can(course, request.user, 'course.join', participation=cp.participation):
+        if not can(course, request.user, 'course.join', participation=cp.participation, request=request):
             messages.error(request, 'You can\'t join this course.')
             return redirect(redirect_url)
 
@@ -74,7 +80,7 @@ def course_add(request):
             messages.error(request, 'The course is already added.')
             return redirect(redirect_url)
 
-        if not can(course, request.user, 'course.add', participation=cp.participation):
+        if not can(course, request.user, 'course.add', participation=cp.participation, request=request):
             messages.error(request, 'You are not allowed to add course.')
             return redirect(redirect_url)
 
@@ -91,7 +97,7 @@ def course_delete(request, course_pk):
 
     cp = course_participation(request.user, course)
 
-    if not can(course, request.user, 'course.delete', participation=cp.participation):
+    if not can(course, request.user, 'course.delete', participation=cp.participation, request=request):
         messages.error(request, 'You can\'t delete this course.')
     else:
         course.delete()
@@ -103,7 +109,7 @@ def course_delete(request, course_pk):
 def course(request, course_pk):
     course = get_object_or_404(Course, pk=course_pk)
 
-    if not can(course, request.user, 'course.view'):
+    if not can(course, request.user, 'course.view', request=request):
         messages.error(request, 'You are not participating in this course.')
         return redirect(reverse('courses'))
 
@@ -113,7 +119,7 @@ def course(request, course_pk):
 def _task_edit(request, course_pk, form_class, task_pk=None):
     course = get_object_or_404(Course, pk=course_pk)
 
-    if not can(course, request.user, 'task.edit'):
+    if not can(course, request.user, 'task.edit', request=request):
         messages.error(request, 'You are not allowed to {} task.'.format('edit' if task_pk else 'add'))
         return redirect(reverse('course', args=(course_pk,)))
 
@@ -147,7 +153,7 @@ def task_edit_code(request, course_pk, task_pk=None):
 def task_delete(request, course_pk, task_pk):
     task = get_object_or_404(Task, pk=task_pk)
 
-    if not can(task.course, request.user, 'task.delete'):
+    if not can(task.course, request.user, 'task.delete', request=request):
         messages.error(request, 'You are not allowed to delete this task.')
     else:
         task.delete()
@@ -160,48 +166,41 @@ def task_download(request, pk):
     task = get_object_or_404(Task, pk=pk)
     redirect_url = reverse('course', args=(task.course.pk,))
 
-    if not can(task.course, request.user, 'task.download'):
+    if not can(task.course, request.user, 'task.download', request=request):
         messages.error(request, 'You are not allowed to download this task.')
         return redirect(redirect_url)
 
-    filename = os.path.basename(task.file.name)
-    response = HttpResponse(task.file, content_type='application/zip')
-    response['Content-Disposition'] = 'attachment; filename=%s' % filename
-
-    return response
+    return utils.create_download_response(request, task.file, 'application/zip', etag=task.file_hash)
 
 @login_required
 def template_download(request, pk):
     task = get_object_or_404(Task, pk=pk)
     redirect_url = reverse('course', args=(task.course.pk,))
 
-    if not can(task.course, request.user, 'task.view'):
+    if not can(task.course, request.user, 'task.view', request=request):
         messages.error(request, 'You are not allowed to download this template.')
         return redirect(redirect_url)
 
-    filename = os.path.basename(task.template.name)
-    response = HttpResponse(task.template, content_type='application/zip')
-    response['Content-Disposition'] = 'attachment; filename=%s' % filename
-
-    return response
+    return utils.create_download_response(request, task.template, 'application/zip')
 
 def _submissions(request, course_pk, task_pk, template='submissions.html', status=None):
     task = get_object_or_404(Task, pk=task_pk)
     redirect_url = reverse('course', args=(task.course.pk,))
 
-    if not can(task.course, request.user, 'task.view'):
+    if not can(task.course, request.user, 'task.view', request=request):
         messages.error(request, 'You are not allowed to view this task.')
         return redirect(redirect_url)
 
     view_all = 'others' in request.GET
     if view_all:
-        if not can(task.course, request.user, 'submission.view'):
+        if not can(task.course, request.user, 'submission.view', request=request):
             messages.error(request, 'You are not allowed to view this task submissions.')
             return redirect(redirect_url)
         submissions = task.submissions.order_by('-created_at')
     else:
         submissions = task.submissions.filter(user=request.user).order_by('-created_at')
-    submissions = submissions.all()
+    # The evaluation details are fetched on expand (partial_submission_details)
+    submissions = submissions.defer('notes')
 
     per_page_options = [10, 20, 50, 100, 1000]
     per_page = request.GET.get('per_page', 10)
@@ -210,30 +209,125 @@ def _submissions(request, course_pk, task_pk, template='submissions.html', statu
     submissions = paginator.get_page(page)
 
     return render(request, template, {'task': task, 'submissions': submissions, 'view_all': view_all,
-                                                'per_page_options': per_page_options}, status=status)
+                                                'per_page_options': per_page_options,
+                                                'can_edit': bool(can(task.course, request.user, 'task.edit', request=request)),
+                                                'events_version': events.get_version(events.task_key(task.pk), '0'),
+                                                'events_push': events.push_enabled(request)}, status=status)
 
 @login_required
 @cache_control(max_age=0, no_cache=True, no_store=True, must_revalidate=True)
 def submissions(request, course_pk, task_pk):
     return _submissions(request, course_pk, task_pk, template='submissions.html')
 
+def _partial_etag(request, version, queue_version=None, stopped=False):
+    # Partials with waiting submissions also change with the queue positions
+    if stopped:
+        return '"{}-{}-stopped"'.format(version, request.user.pk)
+    return '"{}.{}-{}"'.format(version, queue_version, request.user.pk)
+
+def _partial_versions(key):
+    return events.get_version(key), queues.get_version()
+
+def _partial_not_modified(request, version, queue_version):
+    """
+    Answer a poll from the change and queue versions alone, without querying the submissions
+    or rendering: 304 if the client has the current versions, or 286 (stop polling, keep the
+    content) if that version was already final. None if the partial must be rendered, also
+    when a version is unknown (evicted), as an old ETag could match it.
+    """
+    if not settings.EVENTS_CONDITIONAL_PARTIALS or version is None:
+        return None
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    if queue_version is not None and _partial_etag(request, version, queue_version) in etags:
+        response = HttpResponse(status=304)
+    elif _partial_etag(request, version, stopped=True) in etags:
+        response = HttpResponse(status=286, headers={'HX-Reswap': 'none'})
+    else:
+        return None
+    response['ETag'] = etags[0]
+    return response
+
+def _partial_response(request, response, version, queue_version):
+    # The versions are read before the queries, a change made meanwhile gets a new version
+    if not settings.EVENTS_CONDITIONAL_PARTIALS or version is None:
+        return response
+    if response.status_code == 286:
+        response['ETag'] = _partial_etag(request, version, stopped=True)
+    elif response.status_code == 200 and queue_version is not None:
+        response['ETag'] = _partial_etag(request, version, queue_version)
+    return response
+
 @login_required
-@cache_control(max_age=0, no_cache=True, no_store=True, must_revalidate=True)
+@cache_control(max_age=0, no_cache=True, must_revalidate=True, private=True)
 def partial_submissions(request, course_pk, task_pk):
+    versions = _partial_versions(events.task_key(task_pk))
+    response = _partial_not_modified(request, *versions)
+    if response is not None:
+        return response
+
     task = get_object_or_404(Task, pk=task_pk)
     status = None
     if task.submissions.filter(status__in=[Submission.STATUS_QUEUED, Submission.STATUS_RUNNING]).count() == 0:
         status = 286
-    return _submissions(request, course_pk, task_pk, template='partials/submissions.html', status=status)
+    return _partial_response(request, _submissions(request, course_pk, task_pk, template='partials/submissions.html', status=status), *versions)
 
 @login_required
-@cache_control(max_age=0, no_cache=True, no_store=True, must_revalidate=True)
+@cache_control(max_age=0, no_cache=True, must_revalidate=True, private=True)
 def partial_submission(request, pk):
-    submission = get_object_or_404(Submission, pk=pk)
+    versions = _partial_versions(events.submission_key(pk))
+    response = _partial_not_modified(request, *versions)
+    if response is not None:
+        return response
+
+    submission = get_object_or_404(Submission.objects.defer('notes'), pk=pk)
     status = None
     if submission.status not in [Submission.STATUS_QUEUED, Submission.STATUS_RUNNING]:
         status = 286
-    return render(request, 'partials/submission.html', {'submission': submission, 'single': True}, status=status)
+    return _partial_response(request, render(request, 'partials/submission.html', {'submission': submission, 'single': True}, status=status), *versions)
+
+@login_required
+def partial_submission_details(request, pk):
+    submission = get_object_or_404(Submission, pk=pk)
+
+    if not can(submission.task.course, request.user, 'submission.view', submission=submission, request=request):
+        return HttpResponse(status=403)
+
+    response = render(request, 'partials/submission_details.html', {'submission': submission})
+    # The URL carries the evaluation version, a final evaluation only changes with a new one
+    if submission.status in [Submission.STATUS_DONE, Submission.STATUS_ERROR]:
+        patch_cache_control(response, private=True, max_age=settings.SUBMISSION_DETAILS_MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, no_cache=True, max_age=0, must_revalidate=True)
+    return response
+
+def _events_response(request, key, waiting):
+    # Pages only connect when push is enabled, see events.push_enabled; 204 stops the EventSource
+    if not events.push_enabled(request):
+        return HttpResponse(status=204)
+    since = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    response = StreamingHttpResponse(events.stream(key, since, waiting.filter(status=Submission.STATUS_QUEUED)),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+async def submissions_events(request, course_pk, task_pk):
+    task = await aget_object_or_404(Task.objects.select_related('course'), pk=task_pk)
+
+    if not await sync_to_async(can)(task.course, request.user, 'task.view', request=request):
+        return HttpResponse(status=403)
+
+    return _events_response(request, events.task_key(task.pk), task.submissions.all())
+
+@login_required
+async def submission_events(request, pk):
+    submission = await aget_object_or_404(Submission.objects.select_related('task__course'), pk=pk)
+
+    if not await sync_to_async(can)(submission.task.course, request.user, 'submission.view', submission=submission, request=request):
+        return HttpResponse(status=403)
+
+    return _events_response(request, events.submission_key(submission.pk), Submission.objects.filter(pk=submission.pk))
 
 @login_required
 @cache_control(max_age=0, no_cache=True, no_store=True, must_revalidate=True)
@@ -241,11 +335,11 @@ def leaderboard(request, course_pk, task_pk):
     task = get_object_or_404(Task, pk=task_pk)
     redirect_url = reverse('submissions', args=(course_pk,task_pk))
 
-    if not can(task.course, request.user, 'task.view'):
+    if not can(task.course, request.user, 'task.view', request=request):
         messages.error(request, 'You are not participating in this course.')
         return redirect(redirect_url)
 
-    if not can(task.course, request.user, 'task.edit') and not task.leaderboard:
+    if not can(task.course, request.user, 'task.edit', request=request) and not task.leaderboard:
         messages.error(request, 'Task doesn\'t have leaderboard.')
         return redirect(redirect_url)
 
@@ -255,12 +349,12 @@ def leaderboard(request, course_pk, task_pk):
                                 .order_by('-max_point') \
                                 .values('max_point')
 
-    submissions = task.submissions.order_by('-point').filter(point__in=user_maxpoints)
+    submissions = task.submissions.select_related('user').order_by('-point').filter(point__in=user_maxpoints)
 
     # Hack: otherwise will output multiple same user if got the same point on multiple submissions
     leaderboard_list, users = [], {}
     for s in submissions.all():
-        if can(task.course, s.user, 'task.edit'):# or not s.user.is_active:
+        if can(task.course, s.user, 'task.edit', request=request):# or not s.user.is_active:
             continue
         if s.user.id not in users:
             users[s.user.id] = True
@@ -287,7 +381,7 @@ def leaderboard(request, course_pk, task_pk):
              'quantiles': [round(x, 2) for x in utils.quantiles(points, percents=[0.25, 0.75])] }
 
     student_view = 'student_view' in request.GET
-    if not can(task.course, request.user, 'task.edit') or student_view:
+    if not can(task.course, request.user, 'task.edit', request=request) or student_view:
         n_show = max(int(len(leaderboard_list) * 0.5), 20)
         leaderboard_list = leaderboard_list[:n_show] # show only half the submissions
 
@@ -318,14 +412,14 @@ def similarities(request, course_pk, task_pk):
     task = get_object_or_404(Task, pk=task_pk)
     redirect_url = reverse('submissions', args=(course_pk,task_pk))
 
-    if not can(task.course, request.user, 'task.edit') and not task.leaderboard:
+    if not can(task.course, request.user, 'task.edit', request=request) and not task.leaderboard:
         messages.error(request, 'You don\'t have access similarities feature.')
         return redirect(redirect_url)
 
-    similarities_ = task.similarities.order_by('-score', 'submission__created_at').all()
+    similarities_ = task.similarities.select_related('user').order_by('-score', 'submission__created_at').all()
     similarities = []
     for s in similarities_.all():
-        if can(task.course, s.user, 'task.edit') or not s.user.is_active:
+        if can(task.course, s.user, 'task.edit', request=request) or not s.user.is_active:
             continue
         similarities.append(s)
 
@@ -344,7 +438,7 @@ def stats(request, course_pk, task_pk):
     task = get_object_or_404(Task, pk=task_pk)
     redirect_url = reverse('submissions', args=(course_pk,task_pk))
 
-    if not can(task.course, request.user, 'task.edit'):
+    if not can(task.course, request.user, 'task.edit', request=request):
         messages.error(request, 'You can\'t see the stats of this task.')
         return redirect(redirect_url)
 
@@ -415,11 +509,11 @@ def _submission_new(request, course_pk, task_pk, form_class, base_submission=Non
     task = get_object_or_404(Task, pk=task_pk)
     redirect_url = reverse('submissions', args=(course_pk,task_pk))
 
-    if not can(task.course, request.user, 'task.submit'):
+    if not can(task.course, request.user, 'task.submit', request=request):
         messages.error(request, 'You are not allowed to submit this task.')
         return redirect(redirect_url)
 
-    if not can(task.course, request.user, 'task.edit'):
+    if not can(task.course, request.user, 'task.edit', request=request):
         if not task.is_open:
             messages.error(request, 'Task is {}.'.format(task.get_status_display().lower()))
             return redirect(redirect_url)
@@ -434,7 +528,10 @@ def _submission_new(request, course_pk, task_pk, form_class, base_submission=Non
 
     if form_class.__name__ == 'SubmissionCodeForm': # Hack: can't check with isinstance'
         if base_submission is None:
-            base_submission = Submission(file=task.template or Submission.TEMPLATE_ZIP_FILE)
+            if task.template:
+                base_submission = Submission(file=task.template, file_manifest=task.template_manifest)
+            else:
+                base_submission = Submission(file=Submission.TEMPLATE_ZIP_FILE)
 
         base = {"code": base_submission.code}
         if base_submission.pk is None:
@@ -445,22 +542,31 @@ def _submission_new(request, course_pk, task_pk, form_class, base_submission=Non
             base["description"] = f"[FROM {base_submission.name}]"
         form = form_class(request.POST or base, request.FILES or None, instance=submission, base_submission=base_submission)
     else:
-        form = form_class(request.POST or None, request.FILES or None, instance=submission)
+        form = form_class(request.POST or None, request.FILES or None, instance=submission,
+                          upload_errors=getattr(request, 'upload_errors', None))
 
     if request.POST and form.is_valid():
-        form.save()
-        submission_evaluate(request, task, submission)
+        with transaction.atomic():
+            form.save()
+            submission_evaluate(request, task, submission)
 
         messages.success(request, f'Submission created: {submission.name}')
         if "continue" in request.POST:
             return redirect(reverse('submission_clone_code', args=(course_pk,task_pk,submission.pk)))
         return redirect(redirect_url)
 
-    return render(request, 'submission_new.html', {'form': form, 'base_submission': base_submission})
+    events_version = events.get_version(events.submission_key(base_submission.pk), '0') if base_submission and base_submission.pk else None
+    return render(request, 'submission_new.html', {'form': form, 'base_submission': base_submission,
+                                                   'events_version': events_version,
+                                                   'events_push': events.push_enabled(request)})
 
+@csrf_exempt
 @login_required
 def submission_new_package(request, course_pk, task_pk):
-    return _submission_new(request, course_pk, task_pk, form_class=SubmissionForm)
+    # Upload handlers must be set before the CSRF check reads the request body
+    task = get_object_or_404(Task, pk=task_pk)
+    request.upload_handlers.insert(0, MaxSizeUploadHandler(request, task.max_upload_size * 1024))
+    return csrf_protect(_submission_new)(request, course_pk, task_pk, form_class=SubmissionForm)
 
 @login_required
 def _submission_new_code(request, course_pk, task_pk, submission=None):
@@ -483,14 +589,25 @@ def submission_download(request, pk):
     submission = get_object_or_404(Submission, pk=pk)
     redirect_url = reverse('submissions', args=(submission.task.course.pk,submission.task.pk))
 
-    if not can(submission.task.course, request.user, 'submission.download', submission=submission):
+    if not can(submission.task.course, request.user, 'submission.download', submission=submission, request=request):
         messages.error(request, 'You are not allowed to download this submission.')
         return redirect(redirect_url)
 
-    filename = os.path.basename(submission.file.name)
-    response = HttpResponse(submission.file, content_type='application/zip')
-    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return utils.create_download_response(request, submission.file, 'application/zip',
+                                          filename=submission.filename, etag=submission.file_hash)
 
+@login_required
+def submissions_export(request, course_pk, task_pk):
+    task = get_object_or_404(Task, pk=task_pk)
+    redirect_url = reverse('submissions', args=(course_pk,task_pk))
+
+    if not can(task.course, request.user, 'submission.download', request=request):
+        messages.error(request, 'You are not allowed to download the submissions of this task.')
+        return redirect(redirect_url)
+
+    select = 'best' if request.GET.get('select') == 'best' else 'latest'
+    response = StreamingHttpResponse(export_submissions(task, select), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=%s' % f"{make_safe_filename(task.name)}_{select}.zip"
     return response
 
 @login_required
@@ -498,6 +615,8 @@ def submissions_action(request):
     if request.method == 'POST':
         if 'rerun' in request.POST:
             return submissions_rerun(request)
+        if 'regrade' in request.POST:
+            return task_regrade(request)
     return redirect(request.META.get('HTTP_REFERER'))
 
 @login_required
@@ -507,20 +626,31 @@ def submissions_rerun(request):
         submissions_q = Submission.objects.filter(pk__in=pks)
 
         # Permission check
-        for submission in submissions_q.all():
-            if not can(submission.task.course, request.user, 'submission.rerun', submission=submission):
-                redirect_url = reverse('submissions', args=(submission.task.course.pk,submission.task.pk))
-                messages.error(request, 'You are not allowed to rerun this submission: {}.'.format(submission.pk))
-                return redirect(redirect_url)
+        denied = regrades.rerun_denied(request.user, submissions_q)
+        if denied:
+            messages.error(request, 'You are not allowed to rerun this submission: {}.'.format(denied[0]))
+            return redirect(request.META.get('HTTP_REFERER'))
+
+        regrade = regrades.rerun(request, submissions_q)
+        if regrade is None:
+            messages.info(request, 'Submissions re-queued for run: {}.'.format(sorted(pks)))
+        else:
+            messages.info(request, 'Submissions re-queued for run in chunks: {} submission(s).'.format(regrade.total))
 
-        submissions_q.update(status=Submission.STATUS_QUEUED)
+    return redirect(request.META.get('HTTP_REFERER'))
 
-        for submission in submissions_q.all():
-            submission_evaluate(request, submission.task, submission)
+@login_required
+def task_regrade(request):
+    task = get_object_or_404(Task, pk=request.POST.get('regrade'))
+    redirect_url = reverse('submissions', args=(task.course.pk,task.pk))
 
-        messages.info(request, 'Submissions re-queued for run: {}.'.format(sorted(pks)))
+    if not can(task.course, request.user, 'submission.rerun', request=request):
+        messages.error(request, 'You are not allowed to regrade this task.')
+        return redirect(redirect_url)
 
-    return redirect(request.META.get('HTTP_REFERER'))
+    regrade = regrades.rerun(request, task.submissions.all(), task=task)
+    messages.info(request, 'Task regrade started: {} submission(s).'.format(regrade.total))
+    return redirect(redirect_url)
 
 def signup(request):
     if request.method == 'POST':
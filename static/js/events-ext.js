@@ -0,0 +1,20 @@
+// htmx extension following a server-sent event stream: an element with
+// `events-connect="<url>"` inside `hx-ext="events"` is triggered with `events:<name>`
+// for each event of the stream, e.g. hx-trigger="events:changed".
+htmx.defineExtension('events', {
+    onEvent: function (name, evt) {
+        var elt = evt.target;
+        if (name === 'htmx:afterProcessNode') {
+            var url = elt.getAttribute && elt.getAttribute('events-connect');
+            if (!url || elt.eventSource || !window.EventSource) {
+                return;
+            }
+            elt.eventSource = new EventSource(url);
+            elt.eventSource.addEventListener('changed', function (e) {
+                htmx.trigger(elt, 'events:changed', {version: e.data});
+            });
+        } else if (name === 'htmx:beforeCleanupElement' && elt.eventSource) {
+            elt.eventSource.close();
+        }
+    }
+});